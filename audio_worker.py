@@ -0,0 +1,275 @@
+"""Audio pipelines that can run outside the bot process.
+
+Holds the frame mixer shared with music.py and the entry point of an
+audio worker: a child process that runs ffmpeg, mixing and Opus encoding
+for many streams and hands finished Opus packets back to the bot, which
+only forwards them to Discord. This module must stay importable without
+config.json, yt-dlp or OpenAI so workers start cheaply with any
+multiprocessing start method.
+
+Wire protocol (both directions): 4-byte big-endian length, then one type
+byte and the body. b"J" is a JSON object, b"A" is a 4-byte stream id
+followed by one Opus packet. Commands sent to the worker are play,
+overlay, credit and stop. The worker sends back started,
+overlay_done and ended events.
+"""
+import discord
+import numpy as np
+import json
+import struct
+import sys
+import threading
+from collections import deque
+
+FRAME_BYTES = discord.opus.Encoder.FRAME_SIZE  # 20 ms of 48 kHz stereo s16le
+SILENCE = b"\x00" * FRAME_BYTES
+DUCK_RAMP_FRAMES = 5  # 100 ms fade in/out of the duck
+
+class MixerSource(discord.AudioSource):
+    """Mixes a music source with overlay clips (TTS) frame by frame.
+
+    While an overlay plays the music keeps running underneath, ducked to
+    `duck` of its volume, so nothing has to be stopped, seeked or
+    respawned. Opus music is passed through untouched and only decoded
+    while something is mixed on top. Overlays play one after another; `after` is called from the
+    audio thread when each one finishes. The source ends once the music
+    and all overlays are exhausted.
+    """
+    def __init__(self, music=None, volume=1.0, duck=0.35):
+        self.music = music
+        self.volume = volume
+        self.duck = duck
+        self.gain = volume
+        self.overlays = deque()  # [source, gain, after]
+        self.lock = threading.Lock()
+        self.music_frames = 0
+        self.decoder = None
+        self.passthrough = False
+        self.on_first_frame = None  # called from the audio thread with the first music frame
+
+    @property
+    def position(self):
+        """Seconds of music played so far."""
+        return self.music_frames * 0.02
+
+    def overlay(self, source, gain=1.0, after=None):
+        if isinstance(source, dict):
+            source = build_source(source)
+        with self.lock:
+            self.overlays.append([source, gain, after])
+
+    def _next_overlay_frame(self):
+        with self.lock:
+            current = self.overlays[0] if self.overlays else None
+        if current is None:
+            return None, 0.0
+        data = current[0].read()
+        if len(data) == FRAME_BYTES:
+            return data, current[1]
+        with self.lock:
+            self.overlays.popleft()
+        current[0].cleanup()
+        if current[2]:
+            current[2](None)
+        # Hand-off frame between clips: keep ducking, play nothing on top
+        return (SILENCE, 0.0) if self.overlays else (None, 0.0)
+
+    def read(self):
+        music = self.music.read() if self.music else b""
+        opus = bool(music) and self.music.is_opus()
+        while opus and music[:8] in (b"OpusHead", b"OpusTags"):
+            # FFmpegOpusAudio also yields the Ogg header packets, which hold no audio
+            music = self.music.read()
+            opus = bool(music)
+        if music:
+            self.music_frames += 1
+            if self.on_first_frame:
+                self.on_first_frame()
+                self.on_first_frame = None
+        over, over_gain = self._next_overlay_frame()
+        if not music and over is None:
+            return b""
+
+        # Opus music with nothing on top goes out as-is, no decode or re-encode
+        self.passthrough = opus and over is None and self.gain == self.volume
+        if self.passthrough:
+            return music
+        # Likewise PCM at unity gain: ffmpeg already applied the volume
+        if not opus and over is None and self.gain == self.volume == 1.0:
+            return music.ljust(FRAME_BYTES, b"\x00")
+        if opus:
+            if self.decoder is None:
+                self.decoder = discord.opus.Decoder()
+            music = self.decoder.decode(music)
+        elif music and len(music) < FRAME_BYTES:
+            music = music.ljust(FRAME_BYTES, b"\x00")
+
+        target = self.volume * self.duck if over is not None else self.volume
+        step = self.volume * (1 - self.duck) / DUCK_RAMP_FRAMES
+        start = self.gain
+        self.gain = min(target, start + step) if target > start else max(target, start - step)
+
+        out = np.zeros(FRAME_BYTES // 2, dtype=np.float32)
+        if music:
+            samples = np.frombuffer(music, dtype=np.int16).astype(np.float32)
+            if start == self.gain:
+                out += samples * self.gain
+            else:
+                # Per-sample ramp, same gain on both channels of each stereo pair
+                ramp = np.repeat(np.linspace(start, self.gain, FRAME_BYTES // 4, endpoint=False, dtype=np.float32), 2)
+                out += samples * ramp
+        if over is not None and over_gain:
+            out += np.frombuffer(over, dtype=np.int16).astype(np.float32) * over_gain
+        return np.clip(out, -32768, 32767).astype(np.int16).tobytes()
+
+    def is_opus(self):
+        # Asked by the audio player right after each read()
+        return self.passthrough
+
+    def cleanup(self):
+        if self.music:
+            self.music.cleanup()
+        with self.lock:
+            pending, self.overlays = list(self.overlays), deque()
+        for source, _, after in pending:
+            source.cleanup()
+            if after:
+                after(None)
+
+def build_source(spec):
+    """Create an ffmpeg source from a picklable/JSON description."""
+    if spec.get("kind") == "opus":
+        return discord.FFmpegOpusAudio(spec["input"], codec=spec.get("codec"),
+                                       before_options=spec.get("before_options"), options=spec.get("options"))
+    return discord.FFmpegPCMAudio(spec["input"], before_options=spec.get("before_options"), options=spec.get("options"))
+
+HEADER = struct.Struct(">I")
+STREAM_ID = struct.Struct(">I")
+
+def write_message(out, lock, kind, body):
+    with lock:
+        out.write(HEADER.pack(len(body) + 1) + kind + body)
+        out.flush()
+
+def read_message(stream):
+    """(kind, body), or (None, None) once the other side has gone away."""
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None, None
+    data = stream.read(HEADER.unpack(header)[0])
+    return data[:1], data[1:]
+
+class WorkerStream:
+    """One guild's pipeline inside a worker: mixer -> Opus packets, paced by credit."""
+    def __init__(self, worker, stream_id, mixer, credit):
+        self.worker = worker
+        self.stream_id = stream_id
+        self.mixer = mixer
+        self.credit = credit
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=f"stream-{stream_id}", daemon=True)
+
+    def add_credit(self, frames):
+        with self.cond:
+            self.credit += frames
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        encoder = discord.opus.Encoder()
+        prefix = STREAM_ID.pack(self.stream_id)
+        started = False
+        try:
+            while True:
+                with self.cond:
+                    while not self.credit and not self.stopped:
+                        self.cond.wait()
+                    if self.stopped:
+                        break
+                    self.credit -= 1
+                data = self.mixer.read()
+                if not data:
+                    break
+                packet = data if self.mixer.is_opus() else encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                self.worker.send(b"A", prefix + packet)
+                if not started:
+                    started = True
+                    self.worker.event("started", self.stream_id)
+        except Exception as e:
+            print(f"Audio worker stream {self.stream_id} failed: {e}", file=sys.stderr)
+        finally:
+            self.mixer.cleanup()
+            self.worker.streams.pop(self.stream_id, None)
+            self.worker.event("ended", self.stream_id)
+
+class Worker:
+    def __init__(self, inp, out):
+        self.inp = inp
+        self.out = out
+        self.lock = threading.Lock()
+        self.streams = {}
+
+    def send(self, kind, body):
+        write_message(self.out, self.lock, kind, body)
+
+    def event(self, name, stream_id, **fields):
+        self.send(b"J", json.dumps({"event": name, "stream": stream_id, **fields}).encode())
+
+    def handle(self, msg):
+        op = msg["op"]
+        stream_id = msg["stream"]
+        if op == "play":
+            try:
+                mixer = MixerSource(build_source(msg["source"]), volume=msg["volume"], duck=msg["duck"])
+            except Exception as e:
+                # The bot plays silence until it hears "ended", so a stream that never starts must say so
+                print(f"Audio worker stream {stream_id} failed to start: {e}", file=sys.stderr)
+                self.event("ended", stream_id, error=str(e))
+                return
+            stream = self.streams[stream_id] = WorkerStream(self, stream_id, mixer, msg["credit"])
+            stream.thread.start()
+            return
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            if op == "overlay":
+                self.event("overlay_done", stream_id, token=msg["token"])
+            return
+        if op == "credit":
+            stream.add_credit(msg["frames"])
+        elif op == "overlay":
+            token = msg["token"]
+            try:
+                stream.mixer.overlay(msg["source"], gain=msg.get("gain", 1.0),
+                                     after=lambda _: self.event("overlay_done", stream_id, token=token))
+            except Exception:
+                self.event("overlay_done", stream_id, token=token)
+                raise
+        elif op == "stop":
+            stream.stop()
+
+    def serve(self):
+        while True:
+            kind, body = read_message(self.inp)
+            if kind is None:
+                break  # the bot closed our stdin
+            if kind == b"J":
+                try:
+                    self.handle(json.loads(body))
+                except Exception as e:
+                    print(f"Audio worker command failed: {e}", file=sys.stderr)
+        for stream in list(self.streams.values()):
+            stream.stop()
+
+def main():
+    out = sys.stdout.buffer
+    # Keep stray prints from corrupting the protocol stream
+    sys.stdout = sys.stderr
+    Worker(sys.stdin.buffer, out).serve()
+
+if __name__ == "__main__":
+    main()
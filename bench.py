@@ -0,0 +1,443 @@
+"""Offline benchmark for the music bot.
+
+Drives the real `!play`, `!skip`, `!tts`, `!showqueue` commands and
+`MusicPlayer.player_loop` against local stand-ins, so no Discord token or
+network access is needed:
+
+- a stub extractor that returns generated audio files served over local HTTP,
+- a fake OpenAI speech endpoint with configurable latency,
+- fake voice clients that consume 20 ms frames in real time, like
+  discord.py's audio player.
+
+Requires ffmpeg on PATH. Examples:
+
+    python bench.py --guilds 8 --tracks 3
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json   # exit code 1 on regression
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from aiohttp import web
+
+COMMANDS_CHANNEL = 1
+# Metrics where lower is better, compared by --compare
+COMPARED = ["ttfa_p50_ms", "ttfa_p95_ms", "ttfa_warm_p50_ms", "gap_p50_ms", "gap_p95_ms", "showqueue_p95_ms",
+            "tts_p50_ms", "cpu_per_stream_pct", "late_frame_pct"]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def ffmpeg_tone(path, seconds, frequency, codec_args):
+    subprocess.run(["ffmpeg", "-nostdin", "-loglevel", "error", "-f", "lavfi",
+                    "-i", f"sine=frequency={frequency}:duration={seconds}",
+                    "-ac", "2", "-ar", "48000", *codec_args, "-y", path], check=True)
+
+
+def make_media(directory, tracks, seconds):
+    """Generate `tracks` distinct tones plus one TTS clip; returns (track files, tts bytes, acodec)."""
+    try:
+        ffmpeg_tone(os.path.join(directory, "probe.ogg"), 0.1, 440, ["-c:a", "libopus"])
+        ext, codec_args, acodec = "ogg", ["-c:a", "libopus"], "opus"
+    except subprocess.CalledProcessError:
+        ext, codec_args, acodec = "wav", [], "pcm_s16le"
+    files = []
+    for i in range(tracks):
+        name = f"track{i}.{ext}"
+        ffmpeg_tone(os.path.join(directory, name), seconds, 220 + 40 * i, codec_args)
+        files.append(name)
+    tts_path = os.path.join(directory, "speech.mp3")
+    try:
+        ffmpeg_tone(tts_path, 1.0, 880, ["-c:a", "libmp3lame"])
+    except subprocess.CalledProcessError:
+        # ffmpeg probes the content, a WAV named .mp3 still plays
+        ffmpeg_tone(tts_path, 1.0, 880, ["-f", "wav"])
+    with open(tts_path, "rb") as f:
+        return files, f.read(), acodec
+
+
+class FakeServices:
+    """One local HTTP server standing in for YouTube media and the OpenAI speech API."""
+    def __init__(self, media_dir, tts_audio, tts_latency):
+        self.media_dir = media_dir
+        self.tts_audio = tts_audio
+        self.tts_latency = tts_latency
+        self.tts_requests = 0
+        self.port = None
+
+    async def speech(self, request):
+        body = await request.json()
+        self.tts_requests += 1
+        if body.get("response_format") == "pcm":
+            return await self.stream_speech(request)
+        await asyncio.sleep(self.tts_latency)
+        return web.Response(body=self.tts_audio, content_type="audio/mpeg")
+
+    async def stream_speech(self, request):
+        # 1 s of 24 kHz mono s16le: first chunk after a quarter of the
+        # latency, the rest trickling in over the remainder
+        t = np.arange(24000) / 24000
+        pcm = (np.sin(2 * np.pi * 880 * t) * 8000).astype(np.int16).tobytes()
+        chunks = [pcm[i:i + 4800] for i in range(0, len(pcm), 4800)]
+        resp = web.StreamResponse(headers={"Content-Type": "audio/pcm"})
+        await resp.prepare(request)
+        await asyncio.sleep(self.tts_latency / 4)
+        for chunk in chunks:
+            await resp.write(chunk)
+            await asyncio.sleep(self.tts_latency * 0.75 / len(chunks))
+        await resp.write_eof()
+        return resp
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/audio/speech", self.speech)
+        app.router.add_static("/media/", self.media_dir)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = runner.addresses[0][1]
+        return runner
+
+
+class StreamStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.late = 0
+        self.first_frame = {}  # guild id -> perf_counter of its first audio frame
+
+
+class FakeVoiceClient:
+    """Consumes audio like discord.py's AudioPlayer: one read() every 20 ms, paced in real time."""
+    def __init__(self, guild, channel, stats, encoder=None):
+        self.guild = guild
+        self.channel = channel
+        self.stats = stats
+        # Each voice client owns its encoder, as in discord.py; libopus state is not thread-safe
+        self.encoder = encoder() if encoder else None
+        self.source = None
+        self.connected = True
+        self._after = None
+        self._stop = threading.Event()
+        self._playing = False
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self._playing
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, *, after=None):
+        if self._playing:
+            raise RuntimeError("Already playing audio.")
+        self.source = source
+        self._after = after
+        self._stop.clear()
+        self._playing = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        start = time.perf_counter()
+        frames = 0
+        while not self._stop.is_set():
+            data = self.source.read()
+            if not data:
+                break
+            if self.encoder and not self.source.is_opus():
+                self.encoder.encode(data, 960)
+            frames += 1
+            with self.stats.lock:
+                self.stats.frames += 1
+                self.stats.first_frame.setdefault(self.guild.id, time.perf_counter())
+            delay = start + frames * 0.02 - time.perf_counter()
+            if delay < -0.02:
+                with self.stats.lock:
+                    self.stats.late += 1
+            time.sleep(max(0.0, delay))
+        self._playing = False
+        self.source.cleanup()
+        if self._after:
+            self._after(None)
+
+    def stop(self):
+        self._stop.set()
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+
+class FakeMessage:
+    ids = iter(range(1, 1 << 62))
+
+    def __init__(self):
+        self.id = next(FakeMessage.ids)
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+
+
+class FakeContext:
+    def __init__(self, guild_id, stats, encoder, connect_latency=0.0):
+        self.guild = SimpleNamespace(id=guild_id, voice_client=None)
+        self.channel = SimpleNamespace(id=COMMANDS_CHANNEL, send=self.send)
+        voice_channel = SimpleNamespace(id=2000 + guild_id, connect=self.connect)
+        self.author = SimpleNamespace(id=1000 + guild_id, display_name=f"bench-{guild_id}",
+                                      voice=SimpleNamespace(channel=voice_channel))
+        self.stats = stats
+        self.encoder = encoder
+        self.connect_latency = connect_latency
+
+    async def connect(self, timeout=None):
+        # Voice handshake: gateway voice state, UDP discovery, encryption setup
+        await asyncio.sleep(self.connect_latency)
+        self.guild.voice_client = FakeVoiceClient(self.guild, self.author.voice.channel, self.stats, self.encoder)
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        return FakeMessage()
+
+
+def stub_extractor(files, base_url, seconds, latency, acodec):
+    """Stands in for _extract_in_worker: deterministic query -> local track."""
+    def extract(query, opts=None):
+        time.sleep(latency)
+        index = int(hashlib.sha1(query.encode()).hexdigest(), 16) % len(files)
+        video_id = f"bench{index:06d}"
+        return {
+            "id": video_id,
+            "title": f"Bench track {index}",
+            "url": f"{base_url}/media/{files[index]}?expire={int(time.time()) + 6 * 3600}",
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+            "thumbnail": None,
+            "duration": seconds,
+            "acodec": acodec,
+        }
+    return extract
+
+
+async def run_guild(music, guild_id, args, stats, encoder, results):
+    ctx = FakeContext(guild_id, stats, encoder, args.voice_connect_latency)
+    started = time.perf_counter()
+    for k in range(args.tracks):
+        await music.play.callback(ctx, query=f"bench guild {guild_id} song {k}")
+    results["play_cmd"].append(time.perf_counter() - started)
+    player = music.players.get(guild_id)
+
+    await asyncio.sleep(args.track_seconds / 2)
+    t = time.perf_counter()
+    await music.showqueue.callback(ctx)
+    results["showqueue"].append(time.perf_counter() - t)
+    if args.tts:
+        t = time.perf_counter()
+        await music.tts.callback(ctx, text=f"Hello from bench guild {guild_id}")
+        results["tts"].append(time.perf_counter() - t)
+    if args.skip and args.tracks > 1:
+        await music.skip.callback(ctx)
+
+    if player.loop_task:
+        await player.loop_task
+    first = stats.first_frame.pop(guild_id, None)
+    if first:
+        results["ttfa"].append(first - started)
+
+    if args.replay:
+        # A new request after the queue drained; a kept-alive connection skips the handshake
+        started = time.perf_counter()
+        await music.play.callback(ctx, query=f"bench guild {guild_id} song 0")
+        if player.loop_task:
+            await player.loop_task
+        first = stats.first_frame.get(guild_id)
+        if first:
+            results["ttfa_warm"].append(first - started)
+
+
+async def bench(args):
+    workdir = tempfile.mkdtemp(prefix="musicbot-bench-")
+    media_dir = os.path.join(workdir, "media")
+    os.makedirs(media_dir)
+    files, tts_audio, acodec = make_media(media_dir, args.distinct_tracks, args.track_seconds)
+    services = FakeServices(media_dir, tts_audio, args.tts_latency)
+    runner = await services.start()
+    base_url = f"http://127.0.0.1:{services.port}"
+
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump({
+            "token": "bench",
+            "openai_api_key": "bench",
+            "openai_base_url": f"{base_url}/v1",
+            "musicbot_commands_channel": COMMANDS_CHANNEL,
+            "db_path": os.path.join(workdir, "queue.db"),
+            "tts_cache_dir": os.path.join(workdir, "tts_cache"),
+            "audio_cache_dir": os.path.join(workdir, "audio_cache"),
+            "playback_mode": args.playback_mode,
+            "lookahead_tracks": args.lookahead,
+            **json.loads(args.config),
+        }, f)
+    os.environ["MUSICBOT_CONFIG"] = config_path
+    os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+
+    import discord
+    import music
+
+    music._extract_in_worker = stub_extractor(files, base_url, args.track_seconds, args.extract_latency, acodec)
+
+    async def no_presence(**kwargs):
+        pass
+    music.bot.change_presence = no_presence
+    music.outbox.start()
+
+    encoder = None
+    try:
+        if not discord.opus.is_loaded():
+            discord.opus._load_default()
+        if discord.opus.is_loaded():
+            encoder = discord.opus.Encoder
+    except Exception:
+        pass
+
+    stats = StreamStats()
+    results = {"ttfa": [], "ttfa_warm": [], "showqueue": [], "tts": [], "play_cmd": []}
+    usage_before = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    wall = time.perf_counter()
+    await asyncio.gather(*(run_guild(music, 100 + g, args, stats, encoder, results) for g in range(args.guilds)))
+    wall = time.perf_counter() - wall
+    if music.audio_workers:
+        # Reap the workers so their CPU shows up in RUSAGE_CHILDREN
+        for worker in music.audio_workers.workers:
+            worker.proc.stdin.close()
+            worker.proc.wait()
+    usage_after = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+
+    await music.storage.flush()
+    music.storage.close()
+    await runner.cleanup()
+
+    def cpu(before, after):
+        return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    cpu_self = cpu(usage_before[0], usage_after[0])
+    cpu_children = cpu(usage_before[1], usage_after[1])
+    audio_seconds = stats.frames * 0.02
+    gaps = list(music.metrics.samples.get("track_gap_seconds", ()))
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+    return {
+        "guilds": args.guilds,
+        "tracks_per_guild": args.tracks,
+        "playback_mode": args.playback_mode,
+        "opus_encode": encoder is not None,
+        "ttfa_p50_ms": ms(percentile(results["ttfa"], 0.5)),
+        "ttfa_p95_ms": ms(percentile(results["ttfa"], 0.95)),
+        "ttfa_warm_p50_ms": ms(percentile(results["ttfa_warm"], 0.5)),
+        "gap_p50_ms": ms(percentile(gaps, 0.5)),
+        "gap_p95_ms": ms(percentile(gaps, 0.95)),
+        "showqueue_p95_ms": ms(percentile(results["showqueue"], 0.95)),
+        "tts_p50_ms": ms(percentile(results["tts"], 0.5)),
+        "cpu_per_stream_pct": round(100 * (cpu_self + cpu_children) / audio_seconds, 2) if audio_seconds else None,
+        "cpu_python_pct": round(100 * cpu_self / audio_seconds, 2) if audio_seconds else None,
+        "cpu_ffmpeg_pct": round(100 * cpu_children / audio_seconds, 2) if audio_seconds else None,
+        "throughput_streams": round(audio_seconds / wall, 2),
+        "late_frame_pct": round(100 * stats.late / stats.frames, 2) if stats.frames else None,
+        "tts_api_calls": services.tts_requests,
+        "wall_seconds": round(wall, 1),
+    }
+
+
+def print_report(report):
+    rows = [
+        ("time to first audio", f"p50 {report['ttfa_p50_ms']} ms, p95 {report['ttfa_p95_ms']} ms"),
+        ("first audio, 2nd play", f"p50 {report['ttfa_warm_p50_ms']} ms"),
+        ("gap between tracks", f"p50 {report['gap_p50_ms']} ms, p95 {report['gap_p95_ms']} ms"),
+        ("!showqueue", f"p95 {report['showqueue_p95_ms']} ms"),
+        ("!tts (end to end)", f"p50 {report['tts_p50_ms']} ms"),
+        ("CPU per stream", f"{report['cpu_per_stream_pct']} % of a core "
+                           f"(python {report['cpu_python_pct']} %, ffmpeg + workers {report['cpu_ffmpeg_pct']} %)"),
+        ("throughput", f"{report['throughput_streams']} real-time streams, "
+                       f"{report['late_frame_pct']} % late frames"),
+        ("TTS API calls", str(report["tts_api_calls"])),
+    ]
+    print(f"{report['guilds']} guilds x {report['tracks_per_guild']} tracks, "
+          f"{report['playback_mode']} mode, opus encode {'on' if report['opus_encode'] else 'off'}, "
+          f"{report['wall_seconds']} s wall")
+    for name, value in rows:
+        print(f"  {name:<22} {value}")
+
+
+def compare(report, baseline, tolerance):
+    """Return the metrics that got worse than baseline by more than `tolerance`."""
+    worse = []
+    for key in COMPARED:
+        old, new = baseline.get(key), report.get(key)
+        if old is None or new is None:
+            continue
+        # Small absolute floor so sub-millisecond noise isn't a regression
+        if new > old * (1 + tolerance) and new - old > 5:
+            worse.append(f"{key}: {old} -> {new}")
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=4, help="simulated guilds playing at once")
+    parser.add_argument("--tracks", type=int, default=3, help="tracks queued per guild")
+    parser.add_argument("--track-seconds", type=float, default=4.0, help="length of each generated track")
+    parser.add_argument("--distinct-tracks", type=int, default=8, help="number of distinct generated tracks")
+    parser.add_argument("--extract-latency", type=float, default=0.3, help="simulated yt-dlp extraction time")
+    parser.add_argument("--tts-latency", type=float, default=0.4, help="simulated OpenAI speech latency")
+    parser.add_argument("--playback-mode", choices=["pcm", "opus"], default="pcm")
+    parser.add_argument("--lookahead", type=int, default=2)
+    parser.add_argument("--no-tts", dest="tts", action="store_false", help="skip the !tts step")
+    parser.add_argument("--no-skip", dest="skip", action="store_false", help="skip the !skip step")
+    parser.add_argument("--no-replay", dest="replay", action="store_false",
+                        help="skip the second !play after the queue drains")
+    parser.add_argument("--voice-connect-latency", type=float, default=0.3, help="simulated voice handshake time")
+    parser.add_argument("--config", default="{}", help="extra config.json keys as a JSON object")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--save", metavar="PATH", help="write the report to PATH")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved report")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression for --compare")
+    args = parser.parse_args()
+
+    report = asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            worse = compare(report, json.load(f), args.tolerance)
+        if worse:
+            print("Regressions:\n  " + "\n  ".join(worse))
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
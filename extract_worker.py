@@ -0,0 +1,47 @@
+"""yt-dlp extraction, run on the bot's extraction threads or in a child process.
+
+In "thread" extract mode music.py calls `extract` directly. In "process"
+mode every extraction thread owns one child running this file, so
+yt-dlp's CPU-heavy parsing stays off the bot's GIL. Like audio_worker.py
+this module must stay importable without config.json: children are fresh
+interpreters, never forked from the multithreaded bot.
+
+Wire protocol: one JSON object per line. The bot sends {"query", "base",
+"opts"}; the child answers {"info": ...} or {"error": "..."}.
+"""
+import json
+import sys
+import threading
+import yt_dlp
+
+_state = threading.local()
+
+def extract(query, base_opts, opts=None):
+    """Sanitized info dict for `query`; each thread (or child) keeps its own YoutubeDLs."""
+    cache = getattr(_state, "ytdls", None)
+    if cache is None:
+        cache = _state.ytdls = {}
+    merged = {**base_opts, **(opts or {})}
+    key = tuple(sorted(merged.items()))
+    ytdl = cache.get(key)
+    if ytdl is None:
+        ytdl = cache[key] = yt_dlp.YoutubeDL(merged)
+    info = ytdl.extract_info(query, download=False)
+    # Plain JSON-able dict, so results can cross a process boundary
+    return ytdl.sanitize_info(info)
+
+def main():
+    out = sys.stdout.buffer
+    # Keep yt-dlp's own output from corrupting the protocol stream
+    sys.stdout = sys.stderr
+    for line in sys.stdin.buffer:
+        msg = json.loads(line)
+        try:
+            reply = {"info": extract(msg["query"], msg["base"], msg.get("opts"))}
+        except Exception as e:
+            reply = {"error": str(e)}
+        out.write(json.dumps(reply).encode() + b"\n")
+        out.flush()
+
+if __name__ == "__main__":
+    main()
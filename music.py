@@ -1,7 +1,7 @@
 import discord
 from discord.ext import commands
 import asyncio
-import yt_dlp
+import numpy as np
 import json
 import openai
 import re
@@ -9,30 +9,121 @@ import time
 import sqlite3
 import os
 import random
+import hashlib
+import threading
+import unicodedata
+import copy
+import sys
+import traceback
+from contextlib import contextmanager
+from aiohttp import web
+import itertools
+from queue import SimpleQueue, Empty
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import extract_worker
+from audio_worker import MixerSource, FRAME_BYTES, SILENCE, build_source, read_message, write_message, STREAM_ID
 ###skbidi babidi boo 
-# Load config
-with open("config.json", "r") as f:
+# Load config (MUSICBOT_CONFIG points elsewhere, e.g. for the benchmark)
+with open(os.environ.get("MUSICBOT_CONFIG", "config.json"), "r") as f:
     config = json.load(f)
 
 TOKEN = config["token"]
 log_channel_id = config.get("musicbot_log_channel")
 commands_channel_id = int(config.get("musicbot_commands_channel"))
-client = openai.OpenAI(api_key=config["openai_api_key"])
+client = openai.OpenAI(api_key=config["openai_api_key"], base_url=config.get("openai_base_url"))
+TTS_MODEL = "tts-1"
+TTS_CACHE_DIR = config.get("tts_cache_dir", "tts_cache")
+TTS_CACHE_MAX_BYTES = int(config.get("tts_cache_mb", 50)) * 1024 * 1024
+# Play !tts speech as it is synthesized instead of after the whole file arrives
+TTS_STREAMING = bool(config.get("tts_streaming", False))
+TTS_STREAM_TIMEOUT = float(config.get("tts_stream_timeout", 10))
+# CPU speech engine ("espeak-ng" or "piper") used when OpenAI is slow or failing; unset disables it
+TTS_LOCAL_ENGINE = config.get("tts_local_engine")
+TTS_LOCAL_VOICE = config.get("tts_local_voice")  # espeak-ng voice name, or path to a piper .onnx model
+# Seconds OpenAI gets before the local engine races it
+TTS_DEADLINE = float(config.get("tts_deadline", 1.5))
+# Longest a "Now playing" clip may hold up its song; past that the song starts unannounced
+TTS_ANNOUNCE_TIMEOUT = float(config.get("tts_announce_timeout", 3))
+# Transcoded copies of played tracks; 0 disables the audio cache
+AUDIO_CACHE_DIR = config.get("audio_cache_dir", "audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(config.get("audio_cache_mb", 0)) * 1024 * 1024
+AUDIO_CACHE_MAX_DURATION = int(config.get("audio_cache_max_duration", 1200))
+AUDIO_CACHE_BITRATE = config.get("audio_cache_bitrate", "128k")
+# Spacing of queue position keys; moves take the midpoint between neighbours
+QUEUE_POSITION_GAP = 1024.0
+QUEUE_PAGE_SIZE = 10
+# Voice connections stay up this long after the last song or TTS; 0 disconnects right away
+VOICE_IDLE_TIMEOUT = float(config.get("voice_idle_seconds", 120))
+VOICE_CONNECT_TIMEOUT = float(config.get("voice_connect_timeout", 15))
+VOICE_CONNECT_ATTEMPTS = int(config.get("voice_connect_attempts", 3))
+VOICE_HEALTH_INTERVAL = float(config.get("voice_health_seconds", 15))
+# Seconds an idle guild player is kept before it is garbage-collected
+PLAYER_IDLE_TIMEOUT = int(config.get("player_idle_timeout", 300))
+# How often each playing guild's current track and offset are saved for warm restarts
+SNAPSHOT_INTERVAL = float(config.get("snapshot_seconds", 5))
+MUSIC_VOLUME = float(config.get("music_volume", 0.3))
+# Music gain multiplier while a TTS clip plays over it
+DUCK_LEVEL = float(config.get("duck_level", 0.35))
+LOOKAHEAD_TRACKS = int(config.get("lookahead_tracks", 2))
+# Stream URLs expiring sooner than this are re-resolved before playback
+STREAM_URL_MARGIN = int(config.get("stream_url_margin", 600))
+# How long a search query keeps resolving to the same video without asking YouTube again
+QUERY_CACHE_TTL = int(config.get("query_cache_ttl", 7 * 24 * 3600))
+# Answer !play searches from the index of previously played tracks when the match is unambiguous
+LOCAL_SEARCH = bool(config.get("local_search", True))
+# The best local hit must outscore the runner-up by this factor (bm25)
+LOCAL_SEARCH_MARGIN = float(config.get("local_search_margin", 2.0))
+LOCAL_SEARCH_MIN_TOKENS = 2  # single words are too ambiguous to skip YouTube search
+# Share of the hit's title words the query must cover, so "one more" can't stand for "One More Time"
+LOCAL_SEARCH_MIN_COVERAGE = 0.6
+# Idle-time warming of the tracks most played around this hour of day; 0 disables
+PREFETCH_INTERVAL = float(config.get("prefetch_interval", 600))
+PREFETCH_TRACKS = int(config.get("prefetch_tracks", 20))
+PREFETCH_VOICES = int(config.get("prefetch_voices", 3))
+PREFETCH_KBPS = float(config.get("prefetch_kbps", 1000))
+PREFETCH_DISK_BYTES = int(config.get("prefetch_disk_mb", 200)) * 1024 * 1024
+PREFETCH_HISTORY_DAYS = 30
+# Assumed lifetime of stream URLs that carry no expiry
+UNKNOWN_STREAM_TTL = 1800
 
 # Prepare yt_dlp
+# "pcm": ffmpeg decodes to PCM and discord.py encodes Opus per frame.
+# "opus": prefer Opus-native formats and pass packets through untouched.
+PLAYBACK_MODE = config.get("playback_mode", "pcm")
 ytdl_opts = {
-    'format': 'bestaudio/best',
+    'format': 'bestaudio[acodec=opus]/bestaudio/best' if PLAYBACK_MODE == "opus" else 'bestaudio/best',
     'quiet': True,
     'default_search': 'ytsearch1',
-    'noplaylist': True
+    'noplaylist': True,
+    'socket_timeout': 15
 }
-ytdl = yt_dlp.YoutubeDL(ytdl_opts)
+EXTRACT_WORKERS = int(config.get("extract_workers", 4))
+EXTRACT_MODE = config.get("extract_mode", "thread")  # "thread" or "process"
+EXTRACT_TIMEOUT = float(config.get("extract_timeout", 30))
+# Playlists are imported in pages: a small first page so playback starts quickly, then bigger ones
+PLAYLIST_FIRST_PAGE = int(config.get("playlist_first_page", 10))
+PLAYLIST_PAGE_SIZE = int(config.get("playlist_page_size", 100))
+PLAYLIST_MAX_TRACKS = int(config.get("playlist_max_tracks", 500))
+# Child processes running ffmpeg, mixing and Opus encoding; 0 keeps audio in this process
+AUDIO_WORKERS = int(config.get("audio_workers", 0))
+# Frames a worker may run ahead of playback (50 = 1 s)
+AUDIO_WORKER_BUFFER = int(config.get("audio_worker_buffer", 50))
 #test
 # Discord bot setup
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+# "sharded" lets discord.py pick the shard count; shard_count plus shard_ids
+# split the gateway across several bot processes or machines
+SHARD_IDS = config.get("shard_ids")
+if config.get("sharded") or SHARD_IDS:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, help_command=None,
+                                  shard_count=config.get("shard_count"), shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
 
 # Decorator to restrict command usage to the configured channel
 from functools import wraps
@@ -44,33 +135,610 @@ def in_commands_channel():
         return True
     return commands.check(predicate)
 
-# Setup DB (reset each run)
-conn = sqlite3.connect("queue.db")
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS queue (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    guild_id INTEGER,
-    title TEXT,
-    url TEXT,
-    thumbnail TEXT,
-    video_id TEXT
-)
-""")
-conn.commit()
-
-# Clear the queue table on startup
-cursor.execute("DELETE FROM queue")
-conn.commit()
-
-# Ensure user_voice table exists
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS user_voice (
-    user_id INTEGER PRIMARY KEY,
-    voice TEXT
-)
-""")
-conn.commit()
+METRICS_HOST = config.get("metrics_host", "127.0.0.1")
+METRICS_PORT = int(config.get("metrics_port", 0))  # 0 disables the /metrics endpoint
+LOOP_LAG_INTERVAL = 0.1
+# The event loop counts as blocked when a heartbeat is this late
+LOOP_STALL_THRESHOLD = float(config.get("loop_stall_ms", 250)) / 1000
+
+class Metrics:
+    """Latency samples, counters and gauges, served as Prometheus text.
+
+    Samples keep a rolling window for quantiles plus running totals.
+    `observe`/`inc` are safe to call from the audio and DB threads.
+    """
+    def __init__(self, window=500):
+        self.window = window
+        self.samples = {}  # name -> deque of recent values
+        self.totals = {}   # name -> [count, sum]
+        self.counters = {}  # (name, labels) -> value
+        self.collectors = []  # callables yielding (name, labels, value) gauges at scrape time
+
+    def observe(self, name, value):
+        self.samples.setdefault(name, deque(maxlen=self.window)).append(value)
+        total = self.totals.setdefault(name, [0, 0.0])
+        total[0] += 1
+        total[1] += value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def summary(self, name):
+        values = sorted(self.samples.get(name, ()))
+        if not values:
+            return None
+        return {
+            "count": len(values),
+            "avg": sum(values) / len(values),
+            "p50": values[len(values) // 2],
+            "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+            "max": values[-1],
+        }
+
+    def render(self):
+        lines = []
+        for name in sorted(self.samples):
+            values = sorted(self.samples[name])
+            lines.append(f"# TYPE musicbot_{name} summary")
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f'musicbot_{name}{{quantile="{q}"}} {values[min(len(values) - 1, int(len(values) * q))]:.6f}')
+            count, total = self.totals[name]
+            lines.append(f"musicbot_{name}_count {count}")
+            lines.append(f"musicbot_{name}_sum {total:.6f}")
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"musicbot_{name}{_prom_labels(labels)} {value}")
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                lines.append(f"musicbot_{name}{_prom_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+metrics = Metrics()
+
+class LoopWatchdog:
+    """Measures event-loop lag and reports what blocked the loop.
+
+    A heartbeat task wakes every `interval` and records how late it was. A
+    separate thread watches the heartbeat; when it stalls past `threshold`
+    it grabs the loop thread's stack, which names the blocking sync call
+    and the coroutines above it.
+    """
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.stalls = deque(maxlen=20)  # (when, seconds, stack) of recent stalls
+        self.task = None
+
+    def start(self):
+        if self.task and not self.task.done():
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+
+    async def heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            metrics.observe("event_loop_lag_seconds", max(0.0, now - before - self.interval))
+            self.last_beat = now
+
+    def watch(self):
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            beat = self.last_beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)[-8:]) if frame else "(no frame)"
+            self.stalls.append((time.time(), blocked, stack))
+            metrics.inc("event_loop_stalls_total")
+            print(f"⚠️ Event loop blocked for {blocked*1000:.0f} ms in:\n{stack}")
+
+watchdog = LoopWatchdog()
+
+async def serve_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def serve_stalls(request):
+    body = "\n".join(f"--- {time.strftime('%H:%M:%S', time.localtime(when))} blocked {secs*1000:.0f} ms\n{stack}"
+                     for when, secs, stack in watchdog.stalls)
+    return web.Response(text=body or "no stalls recorded\n", content_type="text/plain")
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    app.router.add_get("/stalls", serve_stalls)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+DB_PATH = config.get("db_path", "queue.db")
+# Writes arriving within this window are committed together
+DB_BATCH_WINDOW = float(config.get("db_batch_ms", 50)) / 1000
+
+class Storage:
+    """SQLite access that keeps disk I/O off the event loop.
+
+    Writes are queued to a dedicated writer thread, which applies them in
+    batches with one commit per batch. Reads run on their own connection in
+    a single reader thread; WAL mode lets them proceed while the writer
+    commits. Per-guild queues and voice preferences are mirrored in memory,
+    so playback never waits on SQLite.
+    """
+    def __init__(self, path, batch_window=DB_BATCH_WINDOW):
+        self.batch_window = batch_window
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.setup()
+        self.read_conn = sqlite3.connect(path, check_same_thread=False)
+        self.read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-read")
+        self.writes = SimpleQueue()
+        self.writer = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+        self.writer.start()
+        self.queues = {}   # guild_id -> deque of AudioTrack, loaded on first use
+        self.loading = {}  # guild_id -> task loading that guild's queue
+        self.voices = {}   # user_id -> voice name or None
+
+    def setup(self):
+        # Runs once at startup, before the event loop exists
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER,
+            title TEXT,
+            url TEXT,
+            thumbnail TEXT,
+            video_id TEXT,
+            webpage_url TEXT
+        )
+        """)
+
+        # Migrate databases created before webpage_url existed
+        try:
+            cursor.execute("ALTER TABLE queue ADD COLUMN webpage_url TEXT")
+        except sqlite3.OperationalError:
+            pass
+        # Sparse sort keys: reordering touches one row instead of renumbering the queue
+        try:
+            cursor.execute("ALTER TABLE queue ADD COLUMN position REAL")
+            cursor.execute("UPDATE queue SET position = id * ?", (QUEUE_POSITION_GAP,))
+        except sqlite3.OperationalError:
+            pass
+        cursor.execute("CREATE INDEX IF NOT EXISTS queue_guild_position ON queue (guild_id, position)")
+
+        # Ensure user_voice table exists
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_voice (
+            user_id INTEGER PRIMARY KEY,
+            voice TEXT
+        )
+        """)
+
+        # yt-dlp extraction cache: long-lived track metadata plus the last stream URL
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS track_info (
+            video_id TEXT PRIMARY KEY,
+            title TEXT,
+            thumbnail TEXT,
+            duration INTEGER,
+            webpage_url TEXT,
+            stream_url TEXT,
+            stream_expires INTEGER,
+            updated_at REAL,
+            acodec TEXT
+        )
+        """)
+        try:
+            cursor.execute("ALTER TABLE track_info ADD COLUMN acodec TEXT")
+        except sqlite3.OperationalError:
+            pass
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS query_cache (
+            query TEXT PRIMARY KEY,
+            video_id TEXT,
+            created_at REAL
+        )
+        """)
+
+        # Playback snapshot per guild, restored after a restart
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS player_state (
+            guild_id INTEGER PRIMARY KEY,
+            voice_channel_id INTEGER,
+            text_channel_id INTEGER,
+            user_id INTEGER,
+            title TEXT,
+            url TEXT,
+            thumbnail TEXT,
+            video_id TEXT,
+            webpage_url TEXT,
+            duration INTEGER,
+            acodec TEXT,
+            position REAL,
+            updated_at REAL
+        )
+        """)
+
+        # What was requested, by whom and with which words
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS play_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER,
+            user_id INTEGER,
+            video_id TEXT,
+            query TEXT,
+            played_at REAL,
+            hour INTEGER
+        )
+        """)
+        try:
+            cursor.execute("ALTER TABLE play_history ADD COLUMN hour INTEGER")
+            cursor.execute("UPDATE play_history SET hour = CAST(strftime('%H', played_at, 'unixepoch') AS INTEGER)")
+        except sqlite3.OperationalError:
+            pass
+        cursor.execute("CREATE INDEX IF NOT EXISTS play_history_video ON play_history (video_id)")
+        # Aggregates by hour of day (UTC), guild and user
+        cursor.execute("CREATE INDEX IF NOT EXISTS play_history_hour ON play_history (hour, played_at, video_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS play_history_guild ON play_history (guild_id, played_at, video_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS play_history_user ON play_history (user_id, played_at)")
+
+        # Full-text index over played titles and the queries that found them;
+        # rowid matches track_info's rowid. Some SQLite builds lack FTS5.
+        try:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name='track_search'")
+            exists = cursor.fetchone()
+            cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS track_search USING fts5(
+                title, queries, tokenize='unicode61 remove_diacritics 2'
+            )
+            """)
+            if not exists:
+                cursor.execute("""INSERT INTO track_search (rowid, title, queries)
+                    SELECT t.rowid, t.title, COALESCE((SELECT group_concat(q.query, ' ') FROM query_cache q
+                        WHERE q.video_id = t.video_id AND q.query NOT LIKE 'youtube:%'), '')
+                    FROM track_info t WHERE t.title IS NOT NULL""")
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"Local track search disabled: {e}")
+            self.fts = False
+        self.conn.commit()
+
+    # --- raw access -------------------------------------------------------
+
+    def write(self, sql, params=()):
+        """Queue a write; it is committed by the writer thread shortly after.
+
+        `params` may be a callable, evaluated by the writer thread; writes
+        naming a queue row use this, since the row id is only known once
+        the writer has inserted it.
+        """
+        self.writes.put((sql, params, False))
+
+    def write_many(self, sql, rows):
+        self.writes.put((sql, rows, True))
+
+    def run(self, fn):
+        """Queue fn(conn) for the writer thread, for writes whose results the caller needs."""
+        self.writes.put((fn, None, False))
+
+    async def flush(self):
+        """Wait until every write queued so far is committed."""
+        done = threading.Event()
+        self.writes.put(done)
+        await asyncio.to_thread(done.wait)
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+
+    async def fetchone(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.read_executor, self._read, sql, params, False)
+
+    async def fetchall(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.read_executor, self._read, sql, params, True)
+
+    def _read(self, sql, params, many):
+        with metrics.timer("sqlite_read_seconds"):
+            cur = self.read_conn.execute(sql, params)
+            return cur.fetchall() if many else cur.fetchone()
+
+    def _write_loop(self):
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < 1000:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.writes.get(timeout=timeout))
+                except Empty:
+                    break
+            stop = False
+            flushed = []
+            started = time.monotonic()
+            for item in batch:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    sql, params, many = item
+                    try:
+                        if callable(sql):
+                            sql(self.conn)
+                            continue
+                        if callable(params):
+                            params = params()
+                        if many:
+                            self.conn.executemany(sql, params)
+                        else:
+                            self.conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        print(f"DB write failed ({sql.__name__ if callable(sql) else sql.split()[0]}): {e}")
+            try:
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"DB commit failed: {e}")
+            metrics.observe("sqlite_write_batch_seconds", time.monotonic() - started)
+            for event in flushed:
+                event.set()
+            if stop:
+                return
+
+    # --- queue mirror -----------------------------------------------------
+
+    async def guild_queue(self, guild_id):
+        q = self.queues.get(guild_id)
+        if q is not None:
+            return q
+        task = self.loading.get(guild_id)
+        if task is None:
+            task = self.loading[guild_id] = asyncio.create_task(self.fetchall(
+                "SELECT id, title, url, thumbnail, video_id, webpage_url, position FROM queue WHERE guild_id=? ORDER BY position, id",
+                (guild_id,)))
+        rows = await task
+        self.loading.pop(guild_id, None)
+        if guild_id not in self.queues:
+            q = self.queues[guild_id] = deque()
+            for row in rows:
+                track = AudioTrack(row[1], row[2], row[3], row[4], row[5], queue_id=row[0])
+                track.position = row[6]
+                q.append(track)
+        return self.queues[guild_id]
+
+    async def enqueue(self, guild_id, track):
+        await self.enqueue_many(guild_id, [track])
+
+    async def enqueue_many(self, guild_id, tracks):
+        q = await self.guild_queue(guild_id)
+        rows = []
+        position = q[-1].position if q else 0.0
+        for track in tracks:
+            position += QUEUE_POSITION_GAP
+            track.position = position
+            q.append(track)
+            rows.append((track, (guild_id, track.title, track.url, track.thumbnail, track.video_id, track.webpage_url, position)))
+
+        # SQLite hands out the row ids, so shard processes sharing the database never collide.
+        # Later writes for these rows are queued behind this one and see the ids.
+        def insert_queue_rows(conn):
+            for track, row in rows:
+                track.queue_id = conn.execute("INSERT INTO queue (guild_id, title, url, thumbnail, video_id, webpage_url, position) VALUES (?, ?, ?, ?, ?, ?, ?)", row).lastrowid
+        self.run(insert_queue_rows)
+
+    async def dequeue(self, guild_id):
+        q = await self.guild_queue(guild_id)
+        if not q:
+            return None
+        track = q.popleft()
+        self.write("DELETE FROM queue WHERE id=? AND guild_id=?", lambda: (track.queue_id, guild_id))
+        return track
+
+    async def peek(self, guild_id, limit):
+        q = await self.guild_queue(guild_id)
+        return list(itertools.islice(q, limit))
+
+    async def page(self, guild_id, after, limit):
+        """(index of the first entry, tracks) for up to `limit` entries positioned after `after` (keyset paging)."""
+        q = await self.guild_queue(guild_id)
+        # Binary search by position; bisect's key= would need Python 3.10
+        lo, hi = 0, len(q)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if q[mid].position <= after:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        return start, [q[i] for i in range(start, min(start + limit, len(q)))]
+
+    async def remove(self, guild_id, index):
+        """Remove and return the entry at 0-based `index`."""
+        q = await self.guild_queue(guild_id)
+        track = q[index]
+        del q[index]
+        self.write("DELETE FROM queue WHERE id=? AND guild_id=?", lambda: (track.queue_id, guild_id))
+        return track
+
+    async def move(self, guild_id, src, dst):
+        """Move the entry at 0-based `src` to `dst`; only its own row is rewritten."""
+        q = await self.guild_queue(guild_id)
+        track = q[src]
+        del q[src]
+        q.insert(dst, track)
+        before = q[dst - 1].position if dst > 0 else None
+        after = q[dst + 1].position if dst + 1 < len(q) else None
+        if before is None and after is None:
+            return track
+        if before is None:
+            track.position = after - QUEUE_POSITION_GAP
+        elif after is None:
+            track.position = before + QUEUE_POSITION_GAP
+        else:
+            track.position = (before + after) / 2
+        if before is not None and after is not None and not before < track.position < after:
+            # Ran out of float precision between the neighbours: respace this guild's keys
+            self._renumber(guild_id, q)
+        else:
+            position = track.position
+            self.write("UPDATE queue SET position=? WHERE id=? AND guild_id=?", lambda: (position, track.queue_id, guild_id))
+        return track
+
+    async def shuffle(self, guild_id):
+        q = await self.guild_queue(guild_id)
+        tracks = list(q)
+        random.shuffle(tracks)
+        # Hand the existing keys out in the new order
+        positions = sorted(t.position for t in tracks)
+        for track, position in zip(tracks, positions):
+            track.position = position
+        q.clear()
+        q.extend(tracks)
+        self.write_many("UPDATE queue SET position=? WHERE id=? AND guild_id=?",
+                        lambda: [(position, t.queue_id, guild_id) for t, position in zip(tracks, positions)])
+
+    def _renumber(self, guild_id, q):
+        tracks = list(q)
+        for i, track in enumerate(tracks):
+            track.position = (i + 1) * QUEUE_POSITION_GAP
+        self.write_many("UPDATE queue SET position=? WHERE id=? AND guild_id=?",
+                        lambda: [((i + 1) * QUEUE_POSITION_GAP, t.queue_id, guild_id) for i, t in enumerate(tracks)])
+
+    def clear_queue(self, guild_id):
+        # Queued behind any pending inserts, so rows still being written are deleted too
+        self.queues[guild_id] = deque()
+        self.write("DELETE FROM queue WHERE guild_id=?", (guild_id,))
+
+    def forget_guild(self, guild_id):
+        # Drop an empty mirror; the next access reloads it from disk
+        if not self.queues.get(guild_id):
+            self.queues.pop(guild_id, None)
+
+    # --- playback snapshots -----------------------------------------------
+
+    def save_player_state(self, guild_id, voice_channel_id, text_channel_id, user_id, track, position):
+        self.write("INSERT OR REPLACE INTO player_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (guild_id, voice_channel_id, text_channel_id, user_id, track.title, track.url, track.thumbnail,
+                    track.video_id, track.webpage_url, track.duration, track.acodec, position, time.time()))
+
+    def clear_player_state(self, guild_id):
+        self.write("DELETE FROM player_state WHERE guild_id=?", (guild_id,))
+
+    async def player_states(self):
+        return await self.fetchall("""SELECT guild_id, voice_channel_id, text_channel_id, user_id, title, url, thumbnail,
+            video_id, webpage_url, duration, acodec, position FROM player_state""")
+
+    # --- play history and local search -----------------------------------
+
+    def record_play(self, guild_id, user_id, track, query=None):
+        """Log a request and refresh the track's search entry with its title and past queries."""
+        if not track.video_id:
+            return
+        now = time.time()
+        self.write("INSERT INTO play_history (guild_id, user_id, video_id, query, played_at, hour) VALUES (?, ?, ?, ?, ?, ?)",
+                   (guild_id, user_id, track.video_id, query, now, time.gmtime(now).tm_hour))
+        if not self.fts:
+            return
+        self.write("DELETE FROM track_search WHERE rowid = (SELECT rowid FROM track_info WHERE video_id=?)",
+                   (track.video_id,))
+        self.write("""INSERT INTO track_search (rowid, title, queries)
+            SELECT t.rowid, t.title, COALESCE((SELECT group_concat(DISTINCT h.query) FROM play_history h
+                WHERE h.video_id = t.video_id AND h.query IS NOT NULL), '')
+            FROM track_info t WHERE t.video_id=?""", (track.video_id,))
+
+    async def popular_tracks(self, since, limit, hours=None, guild_id=None):
+        """(video_id, plays) most requested since `since`, optionally only at these UTC hours or in one guild."""
+        where, params = ["played_at > ?"], [since]
+        if hours is not None:
+            where.append(f"hour IN ({', '.join('?' * len(hours))})")
+            params.extend(hours)
+        if guild_id is not None:
+            where.append("guild_id = ?")
+            params.append(guild_id)
+        return await self.fetchall(f"""SELECT video_id, COUNT(*) AS plays FROM play_history
+            WHERE {' AND '.join(where)} GROUP BY video_id ORDER BY plays DESC LIMIT ?""", (*params, limit))
+
+    async def active_users(self, since, limit, hours=None):
+        """(user_id, requests) of the most active requesters, optionally only at these UTC hours."""
+        where, params = "played_at > ?", [since]
+        if hours is not None:
+            where += f" AND hour IN ({', '.join('?' * len(hours))})"
+            params.extend(hours)
+        return await self.fetchall(f"""SELECT user_id, COUNT(*) AS requests FROM play_history
+            WHERE {where} GROUP BY user_id ORDER BY requests DESC LIMIT ?""", (*params, limit))
+
+    async def search_tracks(self, text, limit=10):
+        """Ranked (best first) local matches: (title, stream_url, thumbnail, video_id,
+        webpage_url, stream_expires, duration, acodec, rank, plays) rows."""
+        match = fts_query(text)
+        if not self.fts or not match:
+            return []
+        return await self.fetchall("""SELECT t.title, t.stream_url, t.thumbnail, t.video_id, t.webpage_url,
+                t.stream_expires, t.duration, t.acodec, bm25(track_search, 2.0, 1.0) AS rank,
+                (SELECT COUNT(*) FROM play_history h WHERE h.video_id = t.video_id) AS plays
+            FROM track_search JOIN track_info t ON t.rowid = track_search.rowid
+            WHERE track_search MATCH ? ORDER BY rank LIMIT ?""", (match, limit))
+
+    # --- voice preferences ------------------------------------------------
+
+    async def get_voice(self, user_id):
+        if user_id not in self.voices:
+            row = await self.fetchone("SELECT voice FROM user_voice WHERE user_id=?", (user_id,))
+            self.voices[user_id] = row[0] if row else None
+        return self.voices[user_id]
+
+    def set_voice(self, user_id, voice):
+        self.voices[user_id] = voice
+        self.write("INSERT INTO user_voice (user_id, voice) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET voice=excluded.voice",
+                   (user_id, voice))
+
+def search_words(text):
+    """Casefolded words of `text` without diacritics, roughly as the FTS index tokenizes them."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return re.findall(r"\w+", "".join(c for c in text if not unicodedata.combining(c)))
+
+def title_coverage(query, title):
+    """Fraction of `title`'s words matched (as prefixes) by a word of `query`."""
+    words = search_words(query)
+    title_words = search_words(title)
+    if not title_words:
+        return 0.0
+    return sum(any(t.startswith(w) for w in words) for t in title_words) / len(title_words)
+
+def fts_query(text):
+    """FTS5 query requiring every word of `text` (as a prefix), or None if it has no words."""
+    words = re.findall(r"\w+", text.casefold())
+    return " ".join(f'"{w}"*' for w in words) or None
+
+storage = Storage(DB_PATH)
+metrics.collectors.append(lambda: [("queue_depth", (("guild", guild_id),), len(q)) for guild_id, q in storage.queues.items()])
 
 # Helpers
 def make_embed(desc, color=discord.Color.blurple(), thumb=None, title=None, footer=None):
@@ -83,26 +751,398 @@ def make_embed(desc, color=discord.Color.blurple(), thumb=None, title=None, foot
         embed.set_footer(text=footer)
     return embed
 
+# Outbound message classes, most important first
+REPLY, NOW_PLAYING, PRESENCE, LOG = range(4)
+OUTBOX_CLASS_NAMES = ["reply", "now_playing", "presence", "log"]
+# Minimum spacing per class; superseded updates are dropped while waiting
+OUTBOX_INTERVALS = {REPLY: 0.0, NOW_PLAYING: 1.0, PRESENCE: 12.0, LOG: 0.0}
+LOG_FLUSH_INTERVAL = float(config.get("log_flush_seconds", 3))
+EMBED_DESCRIPTION_LIMIT = 4096
+
+class Outbox:
+    """Background, rate-limit-aware sender for cosmetic Discord traffic.
+
+    Callers enqueue and return immediately, so nothing here is awaited on
+    the playback path. A send with the same key as a pending one replaces
+    it (only the latest presence or now-playing edit goes out), each class
+    is spaced by OUTBOX_INTERVALS, and log lines are batched into one embed
+    per LOG_FLUSH_INTERVAL. Replies get their own worker so they never
+    queue behind a rate-limited background send.
+    """
+    def __init__(self, intervals=OUTBOX_INTERVALS, log_interval=LOG_FLUSH_INTERVAL):
+        self.intervals = intervals
+        self.log_interval = log_interval
+        self.pending = {}  # key -> (priority, seq, factory)
+        self.last_sent = {}  # priority -> monotonic time
+        self.seq = itertools.count()
+        self.wakeup = None  # created in start(): before 3.10 an Event binds the loop current at creation
+        self.log_lines = []  # (text, color)
+        self.log_flush = None
+        self.workers = []
+
+    def start(self):
+        if self.workers and not any(w.done() for w in self.workers):
+            return
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.workers = [asyncio.create_task(self._work({REPLY})),
+                        asyncio.create_task(self._work({NOW_PLAYING, PRESENCE, LOG}))]
+
+    def submit(self, priority, factory, key=None):
+        """Queue `factory()` (a coroutine function) to be sent in the background."""
+        seq = next(self.seq)
+        if key is None:
+            key = ("once", seq)
+        elif key in self.pending:
+            metrics.inc("outbox_superseded_total", kind=OUTBOX_CLASS_NAMES[priority])
+        self.pending[key] = (priority, seq, factory)
+        if self.wakeup:
+            self.wakeup.set()
+
+    def log(self, text, color):
+        self.log_lines.append((text, color))
+        if self.log_flush is None:
+            self.log_flush = asyncio.get_running_loop().call_later(self.log_interval, self._flush_logs)
+
+    def _flush_logs(self):
+        self.log_flush = None
+        lines, self.log_lines = self.log_lines, []
+        # Worst color wins: a red line makes the whole batch red
+        severity = [discord.Color.red(), discord.Color.orange(), discord.Color.gold()]
+        colors = [c for _, c in lines]
+        color = next((c for c in severity if c in colors), colors[-1])
+        chunks, current = [], ""
+        for text, _ in lines:
+            if current and len(current) + len(text) + 1 > EMBED_DESCRIPTION_LIMIT:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n{text}" if current else text[:EMBED_DESCRIPTION_LIMIT]
+        chunks.append(current)
+        for chunk in chunks:
+            self.submit(LOG, lambda chunk=chunk: self._send_log(chunk, color))
+
+    async def _send_log(self, text, color):
+        # Only send logs in the commands channel, else do nothing
+        channel = bot.get_channel(commands_channel_id)
+        if channel:
+            await channel.send(embed=make_embed(text, color))
+
+    def _pick(self, classes):
+        """Return (key, entry) of the next sendable item, or (None, seconds to wait)."""
+        now = time.monotonic()
+        best, wait = None, None
+        for key, entry in self.pending.items():
+            priority = entry[0]
+            if priority not in classes:
+                continue
+            ready_at = self.last_sent.get(priority, 0) + self.intervals.get(priority, 0)
+            if ready_at <= now:
+                if best is None or entry[:2] < best[1][:2]:
+                    best = (key, entry)
+            else:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+        return best if best else (None, wait)
+
+    async def _work(self, classes):
+        while True:
+            key, entry = self._pick(classes)
+            if key is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), entry)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            del self.pending[key]
+            priority, _, factory = entry
+            self.last_sent[priority] = time.monotonic()
+            try:
+                await factory()
+                metrics.inc("outbox_sent_total", kind=OUTBOX_CLASS_NAMES[priority])
+            except Exception as e:
+                print(f"Outbound {OUTBOX_CLASS_NAMES[priority]} failed: {e}")
+
+outbox = Outbox()
+
 async def log_embed(msg, color=discord.Color.blurple()):
-    # Only send logs in the commands channel, else do nothing
-    channel = bot.get_channel(commands_channel_id)
-    if channel:
-        await channel.send(embed=make_embed(msg, color))
+    # Batched and sent in the background; returns immediately
+    outbox.log(msg, color)
+
+class LRUFileCache:
+    """Byte-budgeted LRU of files in one directory, one file per key.
+
+    Index bookkeeping (`get`/`add`) happens on the event loop; the blocking
+    file write (`store`) is meant to be run in a thread.
+    """
+    def __init__(self, directory, max_bytes, suffix):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.entries = OrderedDict()  # key -> size in bytes, oldest first
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            # Half-written files left by a crash are not entries
+            if not name.endswith(suffix) or name.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            found.append((st.st_mtime, name[:len(name) - len(suffix)], st.st_size))
+        # Rebuild recency order from mtimes, which `get` refreshes on every hit
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total += size
+        self._evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def tmp_path(self, key):
+        return f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            # File vanished behind our back
+            self.total -= self.entries.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return path
+
+    def store(self, key, data):
+        # Write under a private name and rename, so a reader never sees a partial file
+        tmp = self.tmp_path(key)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path(key))
+        return self.path(key)
+
+    def add(self, key, size):
+        if key in self.entries:
+            self.total -= self.entries.pop(key)
+        self.entries[key] = size
+        self.total += size
+        self._evict()
+
+    def _evict(self):
+        # Never evict the newest entry, it is about to be played
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+# Keys carry their backend's file suffix (see TTSBackend.cache_key)
+tts_cache = LRUFileCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, "")
+
+class AudioCache(LRUFileCache):
+    """Opus/Ogg copies of played tracks keyed by video id.
+
+    The first play of a track streams from YouTube as usual while a
+    background ffmpeg writes a transcoded copy; later plays read the local
+    file, which starts instantly and seeks without a network round-trip.
+    """
+    def __init__(self, directory, max_bytes, max_duration=AUDIO_CACHE_MAX_DURATION, concurrency=2, gain=1.0):
+        super().__init__(directory, max_bytes, ".ogg")
+        self.max_duration = max_duration
+        # Baked into the file, so Opus passthrough can play it with codec copy
+        self.gain = gain
+        self.jobs = {}  # video_id -> transcode task
+        self.concurrency = concurrency
+        self.slots = None  # created on first use: before 3.10 it would bind the import-time loop
+
+    def cacheable(self, track):
+        # Unknown duration usually means a livestream
+        return bool(track.video_id and track.url and track.duration and track.duration <= self.max_duration)
+
+    def key(self, video_id):
+        return video_id if self.gain == 1.0 else f"{video_id}-g{round(self.gain * 100)}"
+
+    def lookup(self, video_id):
+        return self.get(self.key(video_id))
+
+    def fill(self, track):
+        """Start caching a track in the background unless cached or in progress."""
+        key = self.key(track.video_id)
+        if not self.cacheable(track) or key in self.entries or key in self.jobs:
+            return None
+        task = asyncio.create_task(self._transcode(key, track.url, track.acodec))
+        self.jobs[key] = task
+        task.add_done_callback(lambda _: self.jobs.pop(key, None))
+        return task
+
+    async def _transcode(self, key, url, acodec=None):
+        if acodec == "opus" and self.gain == 1.0:
+            encode = ["-c:a", "copy"]
+        else:
+            encode = ["-af", f"volume={self.gain}", "-c:a", "libopus", "-b:a", AUDIO_CACHE_BITRATE]
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        async with self.slots:
+            tmp = self.tmp_path(key)
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-loglevel", "error",
+                "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+                "-i", url, "-vn", *encode, "-f", "ogg", "-y", tmp,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            ok = False
+            try:
+                ok = await proc.wait() == 0
+            except asyncio.CancelledError:
+                proc.kill()
+                raise
+            finally:
+                if not ok:
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+            if not ok:
+                return
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self.path(key))
+            self.add(key, size)
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES,
+                         gain=MUSIC_VOLUME if PLAYBACK_MODE == "opus" else 1.0) if AUDIO_CACHE_MAX_BYTES > 0 else None
+
+def normalize_tts_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def tts_cache_key(model, voice, text):
+    return hashlib.sha256(f"{model}\0{voice}\0{normalize_tts_text(text)}".encode()).hexdigest()
 
 def extract_vid_id(url):
-    m = re.search(r"(?:youtube\\.com/.+v=|youtu\\.be/)([^&?]{11})", url)
+    if not url:
+        return None
+    m = re.search(r"(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)([A-Za-z0-9_-]{11})", url)
     return m.group(1) if m else None
 
-async def fetch_info(query: str):
-    return await asyncio.to_thread(lambda: ytdl.extract_info(query, download=False))
+def stream_url_expiry(url):
+    """Unix time a googlevideo stream URL stops working, or None if unknown."""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    expire = parse_qs(parsed.query).get("expire")
+    if expire:
+        return int(expire[0])
+    # Manifest-style URLs carry it as a path segment: .../expire/<ts>/...
+    m = re.search(r"/expire/(\d+)", parsed.path)
+    return int(m.group(1)) if m else None
+
+EXTRACT_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extract_worker.py")
+_worker_state = threading.local()
+
+def _extract_in_worker(query, opts=None):
+    # Runs on an extraction thread; in process mode the thread hands the query to its own child
+    if EXTRACT_MODE != "process":
+        return extract_worker.extract(query, ytdl_opts, opts)
+    proc = getattr(_worker_state, "proc", None)
+    if proc is None or proc.poll() is not None:
+        proc = _worker_state.proc = subprocess.Popen([sys.executable, EXTRACT_WORKER_SCRIPT],
+                                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        proc.stdin.write(json.dumps({"query": query, "base": ytdl_opts, "opts": opts}).encode() + b"\n")
+        proc.stdin.flush()
+        line = proc.stdout.readline()
+    except OSError:
+        line = b""
+    if not line:
+        proc.kill()
+        raise RuntimeError("Extraction worker exited")
+    reply = json.loads(line)
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["info"]
+
+class ExtractionPool:
+    """Bounded pool for yt-dlp extraction with per-guild round-robin queuing.
+
+    At most `workers` extractions run at once. Waiting requests are kept in
+    one queue per guild and dispatched one guild at a time, so a burst of
+    `!play` in one server can't starve the others.
+    """
+    def __init__(self, workers=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT):
+        # In process mode each thread only waits on its own extract_worker.py child
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdl")
+        self.slots = workers
+        self.timeout = timeout
+        self.active = 0
+        self.queues = OrderedDict()  # guild_id -> deque of ((query, opts), future)
+
+    async def run(self, query, guild_id=None, opts=None):
+        fut = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(guild_id, deque()).append(((query, opts), fut))
+        self._dispatch()
+        return await fut
+
+    def _dispatch(self):
+        while self.active < self.slots and self.queues:
+            guild_id, pending = next(iter(self.queues.items()))
+            args, fut = pending.popleft()
+            if pending:
+                self.queues.move_to_end(guild_id)
+            else:
+                del self.queues[guild_id]
+            if fut.done():
+                continue  # caller gave up while queued
+            self.active += 1
+            asyncio.create_task(self._work(args, fut))
+
+    async def _work(self, args, fut):
+        job = asyncio.get_running_loop().run_in_executor(self.executor, _extract_in_worker, *args)
+        try:
+            done, _ = await asyncio.wait({job}, timeout=self.timeout)
+            if not done:
+                if not fut.done():
+                    fut.set_exception(asyncio.TimeoutError(f"Extraction timed out after {self.timeout:.0f}s"))
+                # The worker can't be interrupted; keep its slot until it really finishes
+                await asyncio.wait({job})
+            if not fut.done():
+                if job.exception():
+                    fut.set_exception(job.exception())
+                else:
+                    fut.set_result(job.result())
+        finally:
+            self.active -= 1
+            self._dispatch()
+
+extraction_pool = ExtractionPool()
+
+async def fetch_info(query: str, guild_id=None, opts=None):
+    with metrics.timer("fetch_info_seconds"):
+        return await extraction_pool.run(query, guild_id, opts)
+
+def is_playlist_url(query):
+    # A watch URL that happens to carry &list= still means "this song"
+    parsed = urlparse(query.strip())
+    if parsed.scheme not in ("http", "https"):
+        return False
+    params = parse_qs(parsed.query)
+    return "list" in params and ("v" not in params or parsed.path.rstrip("/").endswith("/playlist"))
+
+async def fetch_playlist_page(url, start, end, guild_id=None):
+    """Flat-extract entries start..end (1-based, inclusive) of a playlist."""
+    return await fetch_info(url, guild_id, opts={
+        'extract_flat': 'in_playlist',
+        'noplaylist': False,
+        'playliststart': start,
+        'playlistend': end,
+    })
 
-tts_lock = asyncio.Lock()
 TTS_VOICES = ["nova", "echo", "fable", "onyx", "shimmer", "alloy", "daisy", "dewey", "dylan", "grace", "jane", "jason", "jenny", "karen", "kevin", "laura", "lisa", "logan", "matt", "melissa", "michael", "nancy", "paul", "richard", "samantha", "steven", "susan", "taylor", "william"]
 
 async def get_user_voice(user_id):
-    cursor.execute("SELECT voice FROM user_voice WHERE user_id=?", (user_id,))
-    row = cursor.fetchone()
-    return row[0] if row else "nova"
+    return await storage.get_voice(user_id) or "nova"
 
 @bot.command(name="ttsvoice", help="Set or show your TTS voice. Usage: !ttsvoice <voice>")
 @in_commands_channel()
@@ -131,178 +1171,1212 @@ async def ttsvoice(ctx, *, voice: str = None):
     await ctx.send(embed=make_embed(f"✅ Your TTS voice has been set to **{voice}**.", discord.Color.green(), title="TTS Voice Updated"))
 
 async def set_user_voice(user_id, voice):
-    cursor.execute("INSERT INTO user_voice (user_id, voice) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET voice=excluded.voice", (user_id, voice))
-    conn.commit()
+    storage.set_voice(user_id, voice)
 
-async def generate_tts(text: str, user_id=None) -> str:
-    path = "now.mp3"
-    if user_id:
-        voice = await get_user_voice(user_id)
-    else:
-        voice = "nova"
+class TTSBackend:
+    """A speech engine that turns text into one complete audio file.
+
+    `model` goes into the clip cache key, so clips from different engines
+    never collide, and `suffix` names the container `synthesize` returns.
+    `synthesize` blocks and runs on the backend's own
+    threads, so a hanging API can't starve the default executor or the
+    local engine.
+    """
+    name = None
+    model = None
+    metric = None
+    suffix = ".wav"
+
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"tts-{self.name}")
+
+    def cache_key(self, voice, text):
+        return tts_cache_key(self.model, voice, text) + self.suffix
+
+    def synthesize(self, voice, text):
+        raise NotImplementedError
+
+class OpenAITTS(TTSBackend):
+    name = "openai"
+    model = TTS_MODEL
+    metric = "tts_generate_seconds"
+    suffix = ".mp3"
+
+    def synthesize(self, voice, text):
+        return client.audio.speech.create(model=TTS_MODEL, voice=voice, input=text, response_format="mp3").content
+
+class EspeakTTS(TTSBackend):
+    name = "espeak-ng"
+    model = "espeak-ng"
+    metric = "tts_local_seconds"
+
+    def __init__(self, voice):
+        super().__init__(threads=2)
+        self.voice = voice
+
+    def synthesize(self, voice, text):
+        return subprocess.run(["espeak-ng", "--stdout", "--stdin", "-v", voice], input=text.encode(),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+class PiperTTS(TTSBackend):
+    name = "piper"
+    model = "piper"
+    metric = "tts_local_seconds"
+
+    def __init__(self, voice):
+        super().__init__(threads=2)
+        self.voice = voice  # .onnx model path
+
+    def synthesize(self, voice, text):
+        path = tts_cache.tmp_path(self.cache_key(voice, text))
+        try:
+            subprocess.run(["piper", "--model", voice, "--output_file", path], input=text.encode(),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def local_tts_backend(engine, voice):
+    if not engine:
+        return None
+    if engine == "espeak-ng":
+        return EspeakTTS(voice or "en")
+    if engine == "piper" and voice:
+        return PiperTTS(voice)
+    print(f"Local TTS disabled: unknown engine {engine!r} or missing tts_local_voice")
+    return None
+
+tts_backend = OpenAITTS(threads=8)
+tts_local = local_tts_backend(TTS_LOCAL_ENGINE, TTS_LOCAL_VOICE)
+tts_requests = {}  # cache key -> task synthesizing that clip
+
+async def tts_voice(user_id):
+    return await get_user_voice(user_id) if user_id else "nova"
+
+def tts_request(backend, voice, text):
+    """Task resolving to the cached clip of `text`, or None on failure.
+
+    Concurrent requests for the same clip share one synthesis, and the task
+    is never cancelled by callers giving up on it, so a late clip is still
+    cached for next time.
+    """
+    key = backend.cache_key(voice, text)
+    task = tts_requests.get(key)
+    if task is None:
+        task = tts_requests[key] = asyncio.create_task(_synthesize_tts(backend, key, voice, text))
+        task.started = time.monotonic()
+        task.add_done_callback(lambda _: tts_requests.pop(key, None))
+    return task
+
+async def _synthesize_tts(backend, key, voice, text):
+    path = tts_cache.get(key)
+    if path:
+        return path
+    try:
+        started = time.monotonic()
+        data = await asyncio.get_running_loop().run_in_executor(
+            backend.executor, backend.synthesize, voice, normalize_tts_text(text))
+        path = await asyncio.to_thread(tts_cache.store, key, data)
+        tts_cache.add(key, len(data))
+        metrics.observe(backend.metric, time.monotonic() - started)
+        used = voice if backend is tts_backend else f"{voice} ({backend.name} fallback)"
+        await log_embed(f"\U0001f5e3️ TTS voice used: {used}")
+        return path
+    except Exception as e:
+        print(f"TTS error ({backend.name}, {voice}): {e}")
+        return None
+
+async def generate_tts(text: str, user_id=None, deadline=TTS_DEADLINE) -> str:
+    """Path of a clip speaking `text`, or None.
+
+    OpenAI gets `deadline` seconds from when the clip was first requested
+    (a lookahead may have asked long ago); after that, or as soon as it
+    fails, the local engine (if configured) starts too and whichever clip is
+    ready first is used. With `deadline=None` only OpenAI is asked.
+    """
+    voice = await tts_voice(user_id)
+    path = tts_cache.get(tts_backend.cache_key(voice, text))
+    if path:
+        metrics.inc("tts_cache_hits_total")
+        return path
+    metrics.inc("tts_cache_misses_total")
+    remote = tts_request(tts_backend, voice, text)
+    if not tts_local or deadline is None:
+        return await asyncio.shield(remote)
+    done, _ = await asyncio.wait({remote}, timeout=max(0, deadline - (time.monotonic() - remote.started)))
+    if done and remote.result():
+        return remote.result()
+    local = tts_request(tts_local, tts_local.voice, text)
+    pending = {remote, local}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.result():
+                metrics.inc("tts_hedged_total", winner=tts_backend.name if task is remote else tts_local.name)
+                return task.result()
+    return None
+
+OPUS_SILENCE = b"\xf8\xff\xfe"  # one 20 ms Opus frame of silence
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audio_worker.py")
+
+class RemoteAudioSource(discord.AudioSource):
+    """Opus packets produced by an audio worker, passed straight to Discord.
+
+    Stands in for a MixerSource: it has the same position, overlay and
+    on_first_frame interface, but overlays must be clip descriptions
+    (dicts) because the worker opens them itself. The worker only runs
+    AUDIO_WORKER_BUFFER frames ahead; consumed frames are returned to it
+    as credit. On underrun it sends Opus silence instead of ending.
+    """
+    CREDIT_BATCH = 10
+
+    def __init__(self, worker, stream_id):
+        self.worker = worker
+        self.stream_id = stream_id
+        self.frames = deque()
+        self.ended = False
+        self.music_frames = 0
+        self.consumed = 0
+        self.on_first_frame = None
+        self.overlay_callbacks = {}  # token -> after
+        self.tokens = itertools.count()
+
+    @property
+    def position(self):
+        """Seconds of music played so far."""
+        return self.music_frames * 0.02
+
+    def overlay(self, source, gain=1.0, after=None):
+        if not isinstance(source, dict):
+            raise TypeError("audio workers can only overlay clip descriptions")
+        token = next(self.tokens)
+        if after:
+            self.overlay_callbacks[token] = after
+        self.worker.command(op="overlay", stream=self.stream_id, source=source, gain=gain, token=token)
+
+    def push(self, packet):
+        self.frames.append(packet)
+
+    def handle(self, event):
+        name = event["event"]
+        if name == "overlay_done":
+            after = self.overlay_callbacks.pop(event["token"], None)
+            if after:
+                after(None)
+        elif name == "ended":
+            if event.get("error"):
+                print(f"Audio worker stream {self.stream_id} failed: {event['error']}")
+            self.ended = True
+
+    def read(self):
+        try:
+            packet = self.frames.popleft()
+        except IndexError:
+            return b"" if self.ended else OPUS_SILENCE
+        self.music_frames += 1
+        if self.on_first_frame:
+            self.on_first_frame()
+            self.on_first_frame = None
+        self.consumed += 1
+        if self.consumed == self.CREDIT_BATCH:
+            self.consumed = 0
+            self.worker.command(op="credit", stream=self.stream_id, frames=self.CREDIT_BATCH)
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if not self.ended:
+            self.worker.command(op="stop", stream=self.stream_id)
+        self.worker.streams.pop(self.stream_id, None)
+        # Overlays still pending will never finish; release their waiters
+        callbacks, self.overlay_callbacks = list(self.overlay_callbacks.values()), {}
+        for after in callbacks:
+            after(None)
+
+class AudioWorkerClient:
+    """Bot-side handle on one audio worker process."""
+    def __init__(self, index):
+        self.index = index
+        self.proc = subprocess.Popen([sys.executable, WORKER_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+        self.streams = {}  # stream id -> RemoteAudioSource
+        self.reader = threading.Thread(target=self._read_loop, name=f"audio-worker-{index}", daemon=True)
+        self.reader.start()
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def command(self, **msg):
+        try:
+            write_message(self.proc.stdin, self.lock, b"J", json.dumps(msg).encode())
+        except (BrokenPipeError, ValueError) as e:
+            print(f"Audio worker {self.index} unreachable: {e}")
+
+    def _read_loop(self):
+        while True:
+            kind, body = read_message(self.proc.stdout)
+            if kind is None:
+                break
+            if kind == b"A":
+                stream = self.streams.get(STREAM_ID.unpack_from(body)[0])
+                if stream:
+                    stream.push(body[STREAM_ID.size:])
+            elif kind == b"J":
+                event = json.loads(body)
+                stream = self.streams.get(event["stream"])
+                if stream:
+                    stream.handle(event)
+        # Worker died: let every stream drain and end so players move on
+        print(f"Audio worker {self.index} exited with {self.proc.wait()}")
+        for stream in list(self.streams.values()):
+            stream.handle({"event": "ended"})
+
+class AudioWorkerPool:
+    """Spreads guild audio pipelines over worker processes, least loaded first."""
+    def __init__(self, size):
+        self.size = size
+        self.workers = []
+        self.stream_ids = itertools.count(1)
+        self.worker_ids = itertools.count()
+
+    def worker(self):
+        self.workers = [w for w in self.workers if w.alive()]
+        if len(self.workers) < self.size:
+            self.workers.append(AudioWorkerClient(next(self.worker_ids)))
+        return min(self.workers, key=lambda w: len(w.streams))
+
+    def open(self, spec, volume, duck=DUCK_LEVEL):
+        worker = self.worker()
+        source = RemoteAudioSource(worker, next(self.stream_ids))
+        worker.streams[source.stream_id] = source
+        worker.command(op="play", stream=source.stream_id, source=spec, volume=volume, duck=duck,
+                       credit=AUDIO_WORKER_BUFFER)
+        return source
+
+audio_workers = AudioWorkerPool(AUDIO_WORKERS) if AUDIO_WORKERS > 0 else None
+if audio_workers:
+    metrics.collectors.append(lambda: [("audio_worker_streams", (("worker", w.index),), len(w.streams))
+                                       for w in audio_workers.workers])
+
+def clip_spec(path):
+    """Description of a TTS clip file that either kind of mixer can open."""
+    return {"kind": "pcm", "input": path, "options": "-loglevel panic"}
+
+def attach_mixer(vc):
+    """Return (mixer, needs_play) for overlaying a clip on `vc`.
+
+    Reuses the player's mixer if one is running, wraps whatever else is
+    playing in a new mixer, or returns an idle mixer the caller must play.
+    """
+    source = vc.source if (vc.is_playing() or vc.is_paused()) else None
+    if isinstance(source, (MixerSource, RemoteAudioSource)):
+        return source, False
+    if source is not None:
+        mixer = MixerSource(source, volume=1.0, duck=DUCK_LEVEL)
+        vc.source = mixer
+        return mixer, False
+    return MixerSource(None, volume=1.0, duck=DUCK_LEVEL), True
+
+class StreamingTTSSource(discord.AudioSource):
+    """PCM source fed with a streaming speech response as it arrives.
+
+    The speech API's raw pcm format is 24 kHz mono s16le; each chunk is
+    upsampled to 48 kHz stereo (linear interpolation) and appended to an
+    in-memory buffer. If playback catches up with synthesis the source
+    returns silence rather than ending, so the clip only finishes once
+    the response is complete and the buffer is drained.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.finished = False
+        self.error = None
+        self.carry = b""  # odd trailing byte of the last chunk
+        self.last = 0  # last input sample, for interpolating across chunks
+        self.first_chunk = None  # called from the producer thread once audio is available
+
+    def feed(self, chunk):
+        chunk = self.carry + chunk
+        usable = len(chunk) - len(chunk) % 2
+        self.carry = chunk[usable:]
+        if not usable:
+            return
+        samples = np.frombuffer(chunk[:usable], dtype=np.int16).astype(np.float32)
+        previous = np.concatenate(([self.last], samples[:-1]))
+        self.last = samples[-1]
+        upsampled = np.empty(len(samples) * 2, dtype=np.float32)
+        upsampled[0::2] = (previous + samples) / 2
+        upsampled[1::2] = samples
+        stereo = np.repeat(upsampled, 2).astype(np.int16).tobytes()
+        with self.lock:
+            self.buffer += stereo
+        if self.first_chunk:
+            self.first_chunk()
+            self.first_chunk = None
+
+    def finish(self, error=None):
+        with self.lock:
+            self.finished = True
+            self.error = error
+        if self.first_chunk:
+            self.first_chunk()
+            self.first_chunk = None
+
+    def read(self):
+        with self.lock:
+            if len(self.buffer) >= FRAME_BYTES:
+                frame = bytes(self.buffer[:FRAME_BYTES])
+                del self.buffer[:FRAME_BYTES]
+                return frame
+            if not self.finished:
+                return SILENCE  # underrun: wait for the next chunk
+            if self.buffer:
+                frame = bytes(self.buffer).ljust(FRAME_BYTES, b"\x00")
+                self.buffer.clear()
+                return frame
+            return b""
+
+    def cleanup(self):
+        with self.lock:
+            self.finished = True
+            self.buffer.clear()
+
+def _stream_speech(source, voice, text):
     try:
-        resp = await asyncio.to_thread(
-            client.audio.speech.create,
-            model="tts-1",
+        with client.audio.speech.with_streaming_response.create(
+            model=TTS_MODEL,
             voice=voice,
             input=text,
-            response_format="mp3"
-        )
-        with open(path, "wb") as f:
-            f.write(resp.content)
-        await log_embed(f"\U0001f5e3️ TTS voice used: {voice}")
-        return path
+            response_format="pcm"
+        ) as resp:
+            for chunk in resp.iter_bytes(4096):
+                if source.finished:
+                    break  # playback was stopped
+                source.feed(chunk)
     except Exception as e:
-        print(f"TTS error ({voice}): {e}")
+        source.finish(e)
+        return
+    source.finish()
+
+async def stream_tts(text: str, user_id=None, timeout=TTS_STREAM_TIMEOUT):
+    """Start synthesizing `text` and return a source once the first audio
+    chunk has arrived, or None if the request failed or took longer than
+    `timeout` seconds."""
+    voice = await tts_voice(user_id)
+    source = StreamingTTSSource()
+    ready = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    source.first_chunk = lambda: loop.call_soon_threadsafe(ready.set)
+    started = time.monotonic()
+    producer = loop.run_in_executor(tts_backend.executor, _stream_speech, source, voice, normalize_tts_text(text))
+    try:
+        await asyncio.wait_for(ready.wait(), timeout)
+    except asyncio.TimeoutError:
+        source.cleanup()
+        print(f"TTS stream error ({voice}): no audio after {timeout}s")
+        return None
+    if source.error and not source.buffer:
+        print(f"TTS stream error ({voice}): {source.error}")
         return None
+    metrics.observe("tts_first_chunk_seconds", time.monotonic() - started)
+    producer.add_done_callback(lambda _: metrics.observe("tts_generate_seconds", time.monotonic() - started))
+    await log_embed(f"\U0001f5e3️ TTS voice used: {voice}")
+    return source
 
 class AudioTrack:
-    def __init__(self, title, url, thumbnail, video_id):
+    def __init__(self, title, url, thumbnail, video_id, webpage_url=None, queue_id=None, duration=None, acodec=None):
         self.title = title
         self.url = url
         self.thumbnail = thumbnail
         self.video_id = video_id
+        self.webpage_url = webpage_url
+        self.queue_id = queue_id
+        self.duration = duration
+        self.acodec = acodec
+        self.local_path = None  # set when the audio cache has this track
+        self.requested_at = None  # monotonic time of the !play that started the player
+        self.position = None  # sparse sort key within the guild's queue
 
     @classmethod
-    async def from_query(cls, query):
-        data = await fetch_info(query)
+    async def from_query(cls, query, guild_id=None):
+        return await extraction_cache.resolve(query, guild_id)
+
+    @classmethod
+    def from_flat_entry(cls, entry):
+        """Track from a flat playlist entry; the stream URL is resolved just before playback."""
+        thumbnails = entry.get("thumbnails") or []
+        thumb = thumbnails[-1]["url"] if thumbnails else entry.get("thumbnail")
+        page = entry.get("webpage_url") or entry.get("url")
+        if entry.get("id") and not (page or "").startswith("http"):
+            page = f"https://www.youtube.com/watch?v={entry['id']}"
+        return cls(entry.get("title") or "Unknown title", None, thumb, entry.get("id") or extract_vid_id(page), page,
+                   duration=entry.get("duration"))
+
+    @classmethod
+    def from_info(cls, data):
+        page = data.get("webpage_url") or data.get("original_url")
+        return cls(data["title"], data["url"], data.get("thumbnail"), data.get("id") or extract_vid_id(page), page,
+                   duration=None if data.get("is_live") else data.get("duration"), acodec=data.get("acodec"))
+
+    def stream_is_fresh(self, margin=STREAM_URL_MARGIN):
+        if not self.url:
+            return False
+        expires = stream_url_expiry(self.url)
+        return expires is None or expires - time.time() > margin
+
+    async def ensure_stream(self, guild_id=None):
+        """Re-resolve the stream URL if it is missing or about to expire."""
+        return await extraction_cache.refresh_stream(self, guild_id)
+
+    def opus_spec(self, seek):
+        """Packet passthrough spec, or None when the packets can't be copied as-is.
+
+        Cached files have the music volume baked in; a stream only qualifies
+        if it is Opus and needs no gain. Anything else would cost an ffmpeg
+        decode plus a libopus re-encode, about twice the PCM path.
+        """
+        # One packet per Ogg page: the muxer's default 1 s pages would make every read wait for a full page.
+        options = '-loglevel panic -page_duration 20000'
+        if self.local_path:
+            return {"kind": "opus", "input": self.local_path, "codec": "opus",
+                    "before_options": seek.strip() or None, "options": options}
+        if self.acodec == "opus" and MUSIC_VOLUME == 1.0:
+            return {"kind": "opus", "input": self.url, "codec": "opus", "options": options,
+                    "before_options": f'{seek}-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -vn'}
+        return None
+
+    def check_local(self):
+        """Point the track at its cached audio file, if there is one."""
+        self.local_path = audio_cache.lookup(self.video_id) if audio_cache and self.video_id else None
+        return self.local_path
+
+    def source_spec(self, offset=0):
+        """ffmpeg input and options for this track, from the audio cache when possible."""
+        seek = f'-ss {offset:.2f} ' if offset else ''
+        spec = self.opus_spec(seek) if PLAYBACK_MODE == "opus" else None
+        if spec:
+            return spec
+        # ffmpeg applies the music volume, so the mixer can hand frames through untouched
+        options = f'-loglevel panic -af volume={MUSIC_VOLUME}'
+        if self.local_path:
+            return {"kind": "pcm", "input": self.local_path, "before_options": seek.strip() or None,
+                    "options": options}
+        return {
+            "kind": "pcm",
+            "input": self.url,
+            "before_options": f'{seek}-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -vn',
+            "options": options
+        }
+
+    def source(self, offset=0):
+        """Audio source for this track, from the audio cache when possible."""
+        return build_source(self.source_spec(offset))
+
+def normalize_query(query):
+    query = " ".join(query.split())
+    # URLs are case-sensitive (video ids), search terms are not
+    if re.match(r"https?://", query):
+        vid = extract_vid_id(query)
+        # Every URL form of the same video shares one cache entry
+        return f"youtube:{vid}" if vid else query
+    return query.casefold()
+
+class ExtractionCache:
+    """SQLite-backed yt-dlp metadata cache with single-flight extraction.
+
+    Title, thumbnail and duration are kept indefinitely per video id. The
+    stream URL is reused until shortly before the expiry encoded in it.
+    Concurrent requests for the same query or video share one extraction.
+    """
+    def __init__(self, query_ttl=QUERY_CACHE_TTL):
+        self.query_ttl = query_ttl
+        self.inflight = {}
+
+    async def single_flight(self, key, factory):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # Shield so one impatient caller can't cancel the others' extraction
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def track_from_row(row):
+        """AudioTrack from a (title, stream_url, thumbnail, video_id, webpage_url, stream_expires, duration, acodec) row;
+        a stream URL close to expiry is dropped."""
+        track = AudioTrack(row[0], row[1], row[2], row[3], row[4], duration=row[6], acodec=row[7])
+        if row[5] is None or row[5] - time.time() <= STREAM_URL_MARGIN:
+            track.url = None
+        return track
+
+    async def lookup(self, query_key):
+        row = await storage.fetchone("""SELECT t.title, t.stream_url, t.thumbnail, t.video_id, t.webpage_url, t.stream_expires, t.duration, t.acodec
+            FROM query_cache q JOIN track_info t ON t.video_id = q.video_id
+            WHERE q.query=? AND q.created_at > ?""", (query_key, time.time() - self.query_ttl))
+        return self.track_from_row(row) if row else None
+
+    async def lookup_video(self, video_id):
+        row = await storage.fetchone("""SELECT title, stream_url, thumbnail, video_id, webpage_url, stream_expires, duration, acodec
+            FROM track_info WHERE video_id=?""", (video_id,))
+        return self.track_from_row(row) if row else None
+
+    async def cached_stream(self, video_id):
+        """(stream_url, acodec) if a fresh stream URL is cached, else None."""
+        row = await storage.fetchone("SELECT stream_url, stream_expires, acodec FROM track_info WHERE video_id=?", (video_id,))
+        if row and row[1] and row[1] - time.time() > STREAM_URL_MARGIN:
+            return row[0], row[2]
+        return None
+
+    def store(self, data, query_key=None):
+        video_id = data.get("id")
+        if not video_id:
+            return
+        now = time.time()
+        expires = stream_url_expiry(data["url"]) or int(now + UNKNOWN_STREAM_TTL)
+        storage.write("""INSERT INTO track_info (video_id, title, thumbnail, duration, webpage_url, stream_url, stream_expires, updated_at, acodec)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(video_id) DO UPDATE SET title=excluded.title, thumbnail=excluded.thumbnail,
+                duration=excluded.duration, webpage_url=excluded.webpage_url, stream_url=excluded.stream_url,
+                stream_expires=excluded.stream_expires, updated_at=excluded.updated_at, acodec=excluded.acodec""",
+            (video_id, data["title"], data.get("thumbnail"), data.get("duration"),
+             data.get("webpage_url") or data.get("original_url"), data["url"], expires, now, data.get("acodec")))
+        if query_key:
+            storage.write("INSERT OR REPLACE INTO query_cache (query, video_id, created_at) VALUES (?, ?, ?)",
+                          (query_key, video_id, now))
+
+    async def extract(self, query, query_key=None, guild_id=None):
+        data = await fetch_info(query, guild_id)
         if "entries" in data:
             data = data["entries"][0]
-        return cls(data["title"], data["url"], data.get("thumbnail"), extract_vid_id(data["url"]))
+        self.store(data, query_key)
+        return AudioTrack.from_info(data)
+
+    async def search_local(self, query):
+        """Track from the local index if `query` clearly names one played before.
+
+        Hits are not written to the query cache: a near miss would otherwise
+        stick for QUERY_CACHE_TTL, and the index answers again next time anyway.
+        """
+        if not LOCAL_SEARCH or len(re.findall(r"\w+", query)) < LOCAL_SEARCH_MIN_TOKENS:
+            return None
+        rows = await storage.search_tracks(query, limit=2)
+        # bm25 ranks are negative, more negative is better
+        if not rows or (len(rows) > 1 and rows[0][8] > rows[1][8] * LOCAL_SEARCH_MARGIN):
+            return None
+        # A lone match only proves the words occur in the title, not that they name it
+        if title_coverage(query, rows[0][0]) < LOCAL_SEARCH_MIN_COVERAGE:
+            return None
+        metrics.inc("local_search_hits_total")
+        return self.track_from_row(rows[0])
+
+    async def resolve(self, query, guild_id=None):
+        key = normalize_query(query)
+        track = await self.lookup(key)
+        if not track and not re.match(r"https?://", query):
+            track = await self.search_local(query)
+        if track:
+            return await self.refresh_stream(track, guild_id)
+        track = await self.single_flight(("query", key), lambda: self.extract(query, key, guild_id))
+        # Callers own their track objects; the shared result stays untouched
+        return copy.copy(track)
+
+    async def refresh_stream(self, track, guild_id=None):
+        if track.stream_is_fresh() or not track.webpage_url:
+            return track
+        if track.video_id:
+            # Another guild (or an earlier play) may have resolved it recently
+            cached = await self.cached_stream(track.video_id)
+            if cached:
+                track.url, track.acodec = cached
+                return track
+        key = ("video", track.video_id or track.webpage_url)
+        fresh = await self.single_flight(key, lambda: self.extract(track.webpage_url, guild_id=guild_id))
+        track.url = fresh.url
+        track.acodec = fresh.acodec
+        return track
+
+extraction_cache = ExtractionCache()
+
+class VoiceConnections:
+    """Keeps one voice connection per guild warm and shared by music and TTS.
+
+    Connecting retries with exponential backoff. When a guild goes quiet
+    the connection is kept for `idle_timeout` seconds instead of being
+    dropped, so the next !play or !tts skips the voice handshake.
+    discord.py reconnects a dropped client by itself; a health check only
+    steps in for guilds with a running player once discord.py gave up (no
+    voice client) or the client stayed down longer than its timeout.
+    """
+    def __init__(self, idle_timeout=VOICE_IDLE_TIMEOUT, attempts=VOICE_CONNECT_ATTEMPTS,
+                 health_interval=VOICE_HEALTH_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.attempts = attempts
+        self.health_interval = health_interval
+        self.locks = {}  # guild_id -> lock serializing connects
+        self.channels = {}  # guild_id -> voice channel last connected to
+        self.idle = {}  # guild_id -> pending disconnect handle
+        self.down_since = {}  # guild_id -> monotonic time its client was first seen disconnected
+        self.reconnects = {}  # guild_id -> health check reconnect task
+        self.health_task = None
+
+    def start(self):
+        if self.health_interval > 0 and (self.health_task is None or self.health_task.done()):
+            self.health_task = asyncio.create_task(self.health_check())
+
+    async def connect(self, guild, channel):
+        """Connected voice client for `guild`, joining `channel` if needed; None if joining failed."""
+        self.cancel_idle(guild.id)
+        lock = self.locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            vc = guild.voice_client
+            if vc and not vc.is_connected():
+                # Possibly discord.py reconnecting it; tearing it down would abort that and stop playback
+                deadline = self.down_since.setdefault(guild.id, time.monotonic()) + vc.timeout
+                while guild.voice_client is vc and not vc.is_connected() and time.monotonic() < deadline:
+                    await asyncio.sleep(0.25)
+                vc = guild.voice_client
+            if vc and vc.is_connected():
+                self.down_since.pop(guild.id, None)
+                return vc
+            if channel is None:
+                return None
+            delay = 0.5
+            for attempt in range(self.attempts):
+                if guild.voice_client and not guild.voice_client.is_connected():
+                    # Half-open connection left behind; clear it before retrying
+                    await guild.voice_client.disconnect(force=True)
+                try:
+                    with metrics.timer("voice_connect_seconds"):
+                        vc = await channel.connect(timeout=VOICE_CONNECT_TIMEOUT)
+                    self.channels[guild.id] = channel
+                    self.down_since.pop(guild.id, None)
+                    return vc
+                except discord.errors.ClientException:
+                    # Someone else connected in the meantime
+                    if guild.voice_client and guild.voice_client.is_connected():
+                        return guild.voice_client
+                except (asyncio.TimeoutError, OSError, discord.errors.ConnectionClosed) as e:
+                    print(f"Voice connect to {channel} failed (attempt {attempt + 1}): {e}")
+                metrics.inc("voice_connect_retries_total")
+                if attempt + 1 < self.attempts:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+            return guild.voice_client if guild.voice_client and guild.voice_client.is_connected() else None
+
+    def cancel_idle(self, guild_id):
+        handle = self.idle.pop(guild_id, None)
+        if handle:
+            handle.cancel()
+
+    def release(self, guild):
+        """Nothing needs the connection right now; drop it after the grace period."""
+        self.cancel_idle(guild.id)
+        vc = guild.voice_client
+        if not vc:
+            return
+        members = getattr(vc.channel, "members", None)
+        alone = members is not None and not any(not m.bot for m in members)
+        if self.idle_timeout <= 0 or alone:
+            asyncio.create_task(self.disconnect(guild))
+            return
+        self.idle[guild.id] = asyncio.get_running_loop().call_later(
+            self.idle_timeout, lambda: asyncio.create_task(self.expire(guild)))
+
+    def in_use(self, guild):
+        vc = guild.voice_client
+        player = players.players.get(guild.id)
+        return bool((vc and (vc.is_playing() or vc.is_paused()))
+                    or (player and (player.tts_lock.locked() or (player.loop_task and not player.loop_task.done()))))
+
+    async def expire(self, guild):
+        self.idle.pop(guild.id, None)
+        if not self.in_use(guild):
+            await self.disconnect(guild)
+
+    async def disconnect(self, guild, force=False):
+        self.cancel_idle(guild.id)
+        self.channels.pop(guild.id, None)
+        self.down_since.pop(guild.id, None)
+        if guild.voice_client:
+            await guild.voice_client.disconnect(force=force)
+
+    async def health_check(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            now = time.monotonic()
+            for guild_id, channel in list(self.channels.items()):
+                guild = channel.guild
+                vc = guild.voice_client
+                if vc and vc.is_connected():
+                    self.down_since.pop(guild_id, None)
+                    continue
+                player = players.players.get(guild_id)
+                if not (player and player.loop_task and not player.loop_task.done()):
+                    self.channels.pop(guild_id, None)
+                    self.down_since.pop(guild_id, None)
+                    continue
+                if vc and now - self.down_since.setdefault(guild_id, now) < vc.timeout:
+                    continue  # discord.py is still trying
+                task = self.reconnects.get(guild_id)
+                if task is None or task.done():
+                    # One task per guild, so one guild's backoff doesn't hold up the others
+                    self.reconnects[guild_id] = asyncio.create_task(self.reconnect(guild, channel))
+
+    async def reconnect(self, guild, channel):
+        metrics.inc("voice_reconnects_total")
+        await log_embed(f"🔌 Voice connection lost in **{guild.name}**, reconnecting.", discord.Color.orange())
+        await self.connect(guild, channel)
+
+voice_connections = VoiceConnections()
 
 class MusicPlayer:
-    def __init__(self):
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.tts_lock = asyncio.Lock()
+        self.last_active = time.monotonic()
         self.current = None
         self.playing = False
         self.loop_task = None
-        self.start_time = None
+        self.mixer = None
+        self.prepared = {}  # queued AudioTrack -> task resolving to it, prepared
+        self.song_ended_at = None
+        # Session the loop reports to; set from the command that started it or from a snapshot
+        self.guild = None
+        self.channel = None
+        self.user_id = None
+        self.voice_channel = None
+        self.message = None
+        self.offset = 0.0  # seconds into the current track where playback started
+        self.resume = None  # (track, offset) to play before the queue after a restart
 
     async def add_to_queue(self, guild_id, track):
-        cursor.execute("INSERT INTO queue (guild_id, title, url, thumbnail, video_id) VALUES (?, ?, ?, ?, ?)",
-                       (guild_id, track.title, track.url, track.thumbnail, track.video_id))
-        conn.commit()
+        await storage.enqueue(guild_id, track)
+
+    async def add_many_to_queue(self, guild_id, tracks):
+        await storage.enqueue_many(guild_id, tracks)
 
     async def pop_next(self, guild_id):
-        cursor.execute("SELECT id, title, url, thumbnail, video_id FROM queue WHERE guild_id=? ORDER BY id ASC LIMIT 1", (guild_id,))
-        row = cursor.fetchone()
-        if not row:
-            return None
-        cursor.execute("DELETE FROM queue WHERE id=?", (row[0],))
-        conn.commit()
-        return AudioTrack(row[1], row[2], row[3], row[4])
+        return await storage.dequeue(guild_id)
+
+    async def peek_queue(self, guild_id, limit):
+        return await storage.peek(guild_id, limit)
 
     async def show_queue(self, guild_id):
-        cursor.execute("SELECT title FROM queue WHERE guild_id=? ORDER BY id", (guild_id,))
-        return [row[0] for row in cursor.fetchall()]
+        return [track.title for track in await storage.guild_queue(guild_id)]
+
+    async def remove_from_queue(self, guild_id, index):
+        track = await storage.remove(guild_id, index)
+        await self.queue_changed()
+        return track
+
+    async def move_in_queue(self, guild_id, src, dst):
+        track = await storage.move(guild_id, src, dst)
+        await self.queue_changed()
+        return track
+
+    async def shuffle_queue(self, guild_id):
+        await storage.shuffle(guild_id)
+        await self.queue_changed()
+
+    async def queue_changed(self):
+        # Re-aim the lookahead at whatever is now next
+        if self.loop_task and not self.loop_task.done():
+            await self.schedule_lookahead()
+
+    def is_idle(self):
+        return (not (self.loop_task and not self.loop_task.done())
+                and not self.tts_lock.locked())
 
     async def start_loop(self, ctx, message):
+        self.last_active = time.monotonic()
         if self.loop_task and not self.loop_task.done():
+            await self.schedule_lookahead()
+            return
+        voice = ctx.author.voice
+        self.start_session(ctx.guild, ctx.channel, ctx.author.id, voice.channel if voice else None, message)
+
+    def start_session(self, guild, channel, user_id, voice_channel, message=None):
+        self.guild = guild
+        self.channel = channel
+        self.user_id = user_id
+        self.voice_channel = voice_channel
+        self.message = message
+        self.loop_task = asyncio.create_task(self.player_loop())
+
+    def reply(self, embed):
+        if self.channel and self.channel.id == commands_channel_id:
+            channel = self.channel
+            outbox.submit(REPLY, lambda: channel.send(embed=embed))
+
+    async def prepare_track(self, track, user_id, announce=True):
+        """Make a track ready to play: fresh stream URL, and its announcement clip requested."""
+        if announce:
+            # Only OpenAI is asked here; `announcement` decides on the fallback once the song is due
+            tts_request(tts_backend, await tts_voice(user_id), f"Now playing: {track.title}")
+        try:
+            # A cached copy needs no stream URL at all
+            if not track.check_local():
+                await track.ensure_stream(self.guild_id)
+        except Exception as e:
+            print(f"Stream re-resolve failed for {track.title}: {e}")
+        return track
+
+    async def announcement(self, text):
+        """The clip for a player announcement, or None if it isn't ready within
+        TTS_ANNOUNCE_TIMEOUT; playback never waits longer than that for it."""
+        try:
+            return await asyncio.wait_for(generate_tts(text, user_id=self.user_id), TTS_ANNOUNCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            metrics.inc("tts_announcements_skipped_total")
+            return None
+
+    async def schedule_lookahead(self):
+        """Start preparing the next queued tracks while the current one plays."""
+        if LOOKAHEAD_TRACKS <= 0:
+            return
+        upcoming = await self.peek_queue(self.guild_id, LOOKAHEAD_TRACKS)
+        wanted = set(upcoming)
+        for queued in list(self.prepared):
+            if queued not in wanted:
+                self.prepared.pop(queued).cancel()
+        for t in upcoming:
+            if t not in self.prepared:
+                self.prepared[t] = asyncio.create_task(self.prepare_track(t, self.user_id))
+
+    def announce(self, track, message):
+        # Cosmetic updates go through the outbox and never hold up playback
+        outbox.submit(PRESENCE, lambda: bot.change_presence(
+            activity=discord.Activity(type=discord.ActivityType.listening, name=track.title)), key="presence")
+        if message:
+            outbox.submit(NOW_PLAYING, lambda: message.edit(
+                embed=make_embed(f"🎶 Now playing: **{track.title}**", discord.Color.gold(), thumb=track.thumbnail)),
+                key=("edit", message.id))
+        outbox.log(f"▶️ Now playing: **{track.title}**", discord.Color.gold())
+
+    def record_gap(self):
+        if self.song_ended_at is not None:
+            metrics.observe("track_gap_seconds", time.monotonic() - self.song_ended_at)
+            self.song_ended_at = None
+
+    def snapshot(self):
+        """Queue a write of the current track and offset for a warm restart."""
+        if not (self.playing and self.current and self.mixer):
             return
-        self.loop_task = asyncio.create_task(self.player_loop(ctx, message))
+        vc = self.guild.voice_client if self.guild else None
+        voice_channel = vc.channel if vc and vc.channel else self.voice_channel
+        if not voice_channel:
+            return
+        storage.save_player_state(self.guild_id, voice_channel.id, self.channel.id if self.channel else None,
+                                  self.user_id, self.current, self.offset + self.mixer.position)
 
-    async def player_loop(self, ctx, message):
+    async def player_loop(self):
         while True:
-            track = await self.pop_next(ctx.guild.id)
-            if not track:
-                # Send text message
-                if ctx.channel.id == commands_channel_id:
-                    await ctx.send(embed=make_embed("✅ Queue empty. Disconnecting. Goodbye!", discord.Color.green(), title="Queue Empty"))
-                
-                # Generate and play TTS
-                tts_text = "Queue empty. Disconnecting. Goodbye!"
-                tts_task = asyncio.create_task(generate_tts(tts_text, user_id=ctx.author.id))
-                
-                # Wait for TTS to be generated
-                tts_path = await tts_task
-                if tts_path:
-                    done = asyncio.Event()
-                    def tts_done(_): bot.loop.call_soon_threadsafe(done.set)
-                    try:
-                        vc.play(
-                            discord.PCMVolumeTransformer(
-                                discord.FFmpegPCMAudio(tts_path, options='-loglevel panic'),
-                                volume=1.0
-                            ),
-                            after=tts_done
-                        )
-                        await done.wait()
-                    except Exception as e:
-                        await log_embed(f"⚠️ TTS playback error: {e}", discord.Color.red())
-                
-                self.playing = False
-                if ctx.guild.voice_client:
-                    await ctx.guild.voice_client.disconnect()
-                return
+            if self.resume:
+                # Only the head track is re-resolved; the rest of the queue stays lazy
+                track, offset = self.resume
+                self.resume = None
+                track, tts_path = await self.prepare_track(track, self.user_id, announce=False), None
+            else:
+                track, offset = await self.pop_next(self.guild_id), 0.0
+                if not track:
+                    await self.finish()
+                    # A !play during the goodbye only queued its track, since this loop looked alive
+                    if await self.peek_queue(self.guild_id, 1):
+                        continue
+                    return
+
+                # Use the lookahead result if this track was prepared while the last one played
+                prepared = self.prepared.pop(track, None)
+                if prepared and not prepared.cancelled():
+                    track = await prepared
+                else:
+                    track = await self.prepare_track(track, self.user_id)
+                tts_path = await self.announcement(f"Now playing: {track.title}") if track.url or track.local_path else None
+
+            if not track.url and not track.local_path:
+                await log_embed(f"⚠️ Could not resolve **{track.title}**, skipping.", discord.Color.red())
+                continue
 
             self.current = track
             self.playing = True
-            vc = ctx.guild.voice_client
-            if not vc or not vc.is_connected():
-                if ctx.author.voice and ctx.author.voice.channel:
-                    try:
-                        vc = await ctx.author.voice.channel.connect()
-                    except discord.errors.ClientException:
-                        vc = ctx.guild.voice_client
-                        if not vc:
-                            await ctx.send(embed=make_embed('⚠️ Failed to join voice channel.', discord.Color.red(), title="Connection Error"))
-                            await log_embed('⚠️ Failed to join voice channel.', discord.Color.red())
-                            continue
+            vc = await voice_connections.connect(self.guild, self.voice_channel)
+            if not vc:
+                if self.voice_channel:
+                    self.reply(make_embed('⚠️ Failed to join voice channel.', discord.Color.red(), title="Connection Error"))
+                    await log_embed('⚠️ Failed to join voice channel.', discord.Color.red())
                 else:
-                    await ctx.send(embed=make_embed('⚠️ You must be in a voice channel!', discord.Color.orange(), title="Connection Error"))
+                    self.reply(make_embed('⚠️ You must be in a voice channel!', discord.Color.orange(), title="Connection Error"))
                     await log_embed('⚠️ User not in a voice channel.', discord.Color.red())
-                    continue
+                continue
 
-            await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=track.title))
-            await message.edit(embed=make_embed(f"🎶 Now playing: **{track.title}**", discord.Color.gold(), thumb=track.thumbnail))
-            await log_embed(f"▶️ Now playing: **{track.title}**", discord.Color.gold())
-
-            tts_text = f"Now playing: {track.title}"
-            tts_task = asyncio.create_task(generate_tts(tts_text, user_id=ctx.author.id))
-            audio_stream = discord.PCMVolumeTransformer(
-                discord.FFmpegPCMAudio(
-                    track.url,
-                    before_options='-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -vn',
-                    options='-loglevel panic'
-                ),
-                volume=0.3
-            )
+            # A !tts clip on the otherwise idle connection is let finish; vc.play refuses while it plays
+            while vc.is_playing() and isinstance(vc.source, MixerSource) and vc.source.music is None:
+                await asyncio.sleep(0.02)
 
-            tts_path = await tts_task
+            self.announce(track, self.message)
+
+            # Every spec already carries the music volume (ffmpeg filter, or baked into cached files)
+            spec = track.source_spec(offset)
+            if audio_workers:
+                mixer = audio_workers.open(spec, 1.0)
+            else:
+                with metrics.timer("ffmpeg_spawn_seconds"):
+                    source = build_source(spec)
+                mixer = MixerSource(source, volume=1.0, duck=DUCK_LEVEL)
+            if track.requested_at:
+                requested_at = track.requested_at
+                mixer.on_first_frame = lambda: metrics.observe("time_to_first_audio_seconds", time.monotonic() - requested_at)
+            # The announcement plays over the (ducked) start of the song
             if tts_path:
-                done = asyncio.Event()
-                def tts_done(_): bot.loop.call_soon_threadsafe(done.set)
-                try:
-                    vc.play(
-                        discord.PCMVolumeTransformer(
-                            discord.FFmpegPCMAudio(tts_path, options='-loglevel panic'),
-                            volume=1.0
-                        ),
-                        after=tts_done
-                    )
-                    await done.wait()
-                except Exception as e:
-                    await log_embed(f"⚠️ TTS playback error: {e}", discord.Color.red())
+                mixer.overlay(clip_spec(tts_path))
 
             done = asyncio.Event()
-            def song_done(_): bot.loop.call_soon_threadsafe(done.set)
+            loop = asyncio.get_running_loop()
+            def song_done(_):
+                self.song_ended_at = time.monotonic()
+                loop.call_soon_threadsafe(done.set)
             try:
-                vc.play(audio_stream, after=song_done)
-                self.start_time = time.time()
+                vc.play(mixer, after=song_done)
+                self.mixer = mixer
+                self.offset = offset
+                self.snapshot()
+                self.record_gap()
+                if audio_cache and not track.local_path:
+                    audio_cache.fill(track)
+                await self.schedule_lookahead()
                 await done.wait()
             except Exception as e:
                 await log_embed(f"⚠️ Playback failed: {e}", discord.Color.red())
                 continue
+            finally:
+                self.mixer = None
+
+    async def finish(self):
+        """Queue ran dry: say goodbye, disconnect and drop the snapshot."""
+        for task in self.prepared.values():
+            task.cancel()
+        self.prepared.clear()
+        storage.clear_player_state(self.guild_id)
+        # Without a grace period the bot leaves right after this
+        tts_text = "Queue empty. Disconnecting. Goodbye!" if voice_connections.idle_timeout <= 0 else "Queue empty."
+        # Send text message
+        self.reply(make_embed(f"✅ {tts_text}", discord.Color.green(), title="Queue Empty"))
+
+        # Generate and play TTS; a hung request must not keep the loop (and a new !play) waiting
+        tts_path = await self.announcement(tts_text)
+        vc = self.guild.voice_client
+        if tts_path and vc:
+            done = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            def tts_done(_): loop.call_soon_threadsafe(done.set)
+            try:
+                # Mixed like !tts, so a clip already speaking on the connection isn't cut off
+                mixer, needs_play = attach_mixer(vc)
+                mixer.overlay(clip_spec(tts_path), after=tts_done)
+                if needs_play:
+                    vc.play(mixer)
+                await done.wait()
+            except Exception as e:
+                await log_embed(f"⚠️ TTS playback error: {e}", discord.Color.red())
 
-music = MusicPlayer()
+        self.current = None
+        self.playing = False
+        self.song_ended_at = None
+        self.last_active = time.monotonic()
+        # Stay connected for a while; the next !play then starts without a voice handshake
+        voice_connections.release(self.guild)
+
+class PlayerManager:
+    """One MusicPlayer per guild, created on first use and dropped once idle."""
+    def __init__(self, idle_timeout=PLAYER_IDLE_TIMEOUT, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.players = {}
+        self.idle_timeout = idle_timeout
+        self.snapshot_interval = snapshot_interval
+        self.sweep_task = None
+        self.snapshot_task = None
+
+    def get(self, guild_id):
+        player = self.players.get(guild_id)
+        if player is None:
+            player = self.players[guild_id] = MusicPlayer(guild_id)
+        player.last_active = time.monotonic()
+        return player
+
+    def start_sweeper(self):
+        if self.sweep_task is None or self.sweep_task.done():
+            self.sweep_task = asyncio.create_task(self.sweep())
+        if self.snapshot_interval > 0 and (self.snapshot_task is None or self.snapshot_task.done()):
+            self.snapshot_task = asyncio.create_task(self.snapshots())
+
+    async def sweep(self):
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            for guild_id, player in list(self.players.items()):
+                if player.is_idle() and now - player.last_active > self.idle_timeout:
+                    del self.players[guild_id]
+                    storage.forget_guild(guild_id)
+
+    async def snapshots(self):
+        # One batched write per playing guild; the writer thread commits them together
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            for player in list(self.players.values()):
+                player.snapshot()
+
+    async def restore(self):
+        """Resume every guild that was playing when the bot last stopped."""
+        states = await storage.player_states()
+        if states:
+            results = await asyncio.gather(*(self.restore_guild(*row) for row in states), return_exceptions=True)
+            resumed = sum(1 for r in results if r is True)
+            print(f"Restored playback in {resumed}/{len(states)} guilds")
+
+    async def restore_guild(self, guild_id, voice_channel_id, text_channel_id, user_id,
+                            title, url, thumbnail, video_id, webpage_url, duration, acodec, position):
+        guild = bot.get_guild(guild_id)
+        if guild is None and SHARD_IDS:
+            return False  # served by another bot process's shards
+        voice_channel = guild.get_channel(voice_channel_id) if guild else None
+        # Nobody left to listen (or the channel is gone): drop the session
+        if not voice_channel or not any(not m.bot for m in voice_channel.members):
+            storage.clear_player_state(guild_id)
+            return False
+        player = self.get(guild_id)
+        if player.loop_task and not player.loop_task.done():
+            return False
+        track = AudioTrack(title, url, thumbnail, video_id, webpage_url, duration=duration, acodec=acodec)
+        if not duration or position < duration - 1:
+            player.resume = (track, position)
+        if not await voice_connections.connect(guild, voice_channel):
+            print(f"Restore failed to join voice in guild {guild_id}")
+            player.resume = None
+            return False
+        player.start_session(guild, guild.get_channel(text_channel_id), user_id, voice_channel)
+        if player.resume:
+            player.reply(make_embed(f"🔁 Resuming **{title}** after a restart.", discord.Color.blurple(), thumb=thumbnail))
+        return True
+
+players = PlayerManager()
+
+class Prefetcher:
+    """Warms caches for the tracks most likely to be requested soon.
+
+    Every `interval` seconds it takes the tracks most played around this
+    hour of day (UTC), refreshes their stream URLs, pre-generates their
+    "Now playing" clips in the voices of the most active requesters and,
+    with the audio cache enabled, downloads them. It only works while no
+    extraction or transcode is pending, stops as soon as real traffic
+    appears, paces downloads to `kbps` and keeps prefetched audio on disk
+    under `disk_bytes`.
+    """
+    def __init__(self, interval=PREFETCH_INTERVAL, tracks=PREFETCH_TRACKS, voices=PREFETCH_VOICES,
+                 kbps=PREFETCH_KBPS, disk_bytes=PREFETCH_DISK_BYTES):
+        self.interval = interval
+        self.tracks = tracks
+        self.voices = voices
+        self.kbps = kbps
+        self.disk_bytes = disk_bytes
+        self.prefetched = set()  # audio cache keys written by the prefetcher
+        self.task = None
+
+    def start(self):
+        if self.interval > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    def idle(self):
+        return (not extraction_pool.active and not extraction_pool.queues
+                and not (audio_cache and audio_cache.jobs))
+
+    def disk_used(self):
+        self.prefetched &= audio_cache.entries.keys()  # forget what the LRU evicted
+        return sum(audio_cache.entries[key] for key in self.prefetched)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.cycle()
+            except Exception as e:
+                print(f"Prefetch failed: {e}")
+
+    async def cycle(self):
+        if not self.idle():
+            return
+        hour = time.gmtime().tm_hour
+        hours = (hour, (hour + 1) % 24)
+        since = time.time() - PREFETCH_HISTORY_DAYS * 86400
+        popular = await storage.popular_tracks(since, self.tracks, hours=hours)
+        users = await storage.active_users(since, self.voices * 3, hours=hours)
+        # One requester per distinct voice is enough to warm that voice's clips
+        voices = {}
+        for user_id, _ in users:
+            voices.setdefault(await get_user_voice(user_id), user_id)
+        voice_users = list(voices.values())[:self.voices]
+        warmed = 0
+        for video_id, _ in popular:
+            if not self.idle():
+                break  # real requests came in; pick up again next cycle
+            track = await extraction_cache.lookup_video(video_id)
+            if not track or not track.webpage_url:
+                continue
+            if audio_cache and audio_cache.lookup(video_id):
+                track.local_path = audio_cache.lookup(video_id)
+            else:
+                await extraction_cache.refresh_stream(track, "prefetch")
+            for user_id in voice_users:
+                await generate_tts(f"Now playing: {track.title}", user_id=user_id, deadline=None)
+            if not track.local_path:
+                await self.download(track)
+            warmed += 1
+        if warmed:
+            metrics.inc("prefetch_tracks_total", warmed)
+
+    async def download(self, track):
+        if not audio_cache or not audio_cache.cacheable(track):
+            return
+        bitrate = AUDIO_CACHE_BITRATE.lower()
+        bits_per_second = float(bitrate[:-1]) * 1000 if bitrate.endswith("k") else float(bitrate)
+        estimate = track.duration * bits_per_second / 8
+        if self.disk_used() + estimate > self.disk_bytes:
+            return
+        started = time.monotonic()
+        task = audio_cache.fill(track)
+        if not task:
+            return
+        await task
+        key = audio_cache.key(track.video_id)
+        if key in audio_cache.entries:
+            self.prefetched.add(key)
+            # Average the download down to the bandwidth budget
+            pause = audio_cache.entries[key] * 8 / (self.kbps * 1000) - (time.monotonic() - started)
+            if pause > 0:
+                await asyncio.sleep(pause)
+
+prefetcher = Prefetcher()
 
 @bot.command(name="play", help="Play a song from YouTube via search or URL.")
 @in_commands_channel()
 async def play(ctx, *, query: str):
     if not ctx.author.voice:
         return await ctx.send(embed=make_embed("❌ Join a voice channel first.", discord.Color.orange(), title="Connection Error"))
+    requested_at = time.monotonic()
     msg = await ctx.send(embed=make_embed(f"🔍 Searching: `{query}`"))
+    if is_playlist_url(query):
+        return await import_playlist(ctx, msg, query, requested_at)
     try:
-        track = await AudioTrack.from_query(query)
+        track = await AudioTrack.from_query(query, ctx.guild.id)
+        storage.record_play(ctx.guild.id, ctx.author.id, track, None if re.match(r"https?://", query) else query)
+        music = players.get(ctx.guild.id)
+        if not music.playing:
+            track.requested_at = requested_at
         await music.add_to_queue(ctx.guild.id, track)
         await msg.edit(embed=make_embed(f"✅ Queued: **{track.title}**", discord.Color.green(), thumb=track.thumbnail))
         await log_embed(f"✅ Queued by {ctx.author.display_name}: {track.title}")
@@ -310,6 +2384,44 @@ async def play(ctx, *, query: str):
     except Exception as e:
         await msg.edit(embed=make_embed(f"❌ Error: {e}", discord.Color.red(), title="Error"))
 
+async def import_playlist(ctx, msg, url, requested_at=None):
+    """Queue a playlist page by page; playback starts after the first page."""
+    music = players.get(ctx.guild.id)
+    # Progress shares the now-playing edit key of `msg`, so only the latest edit goes out
+    def progress(embed):
+        outbox.submit(NOW_PLAYING, lambda: msg.edit(embed=embed), key=("edit", msg.id))
+    queued = 0
+    start = 1
+    page_size = PLAYLIST_FIRST_PAGE
+    name = "playlist"
+    try:
+        while queued < PLAYLIST_MAX_TRACKS:
+            end = min(start + page_size - 1, PLAYLIST_MAX_TRACKS)
+            data = await fetch_playlist_page(url, start, end, ctx.guild.id)
+            name = data.get("title") or name
+            entries = [e for e in (data.get("entries") or []) if e and e.get("id")]
+            if entries:
+                tracks = [AudioTrack.from_flat_entry(e) for e in entries]
+                if not queued and not music.playing:
+                    # The track that starts playback records time to first audio, as in !play
+                    tracks[0].requested_at = requested_at
+                await music.add_many_to_queue(ctx.guild.id, tracks)
+                queued += len(entries)
+                progress(make_embed(f"📃 Queued {queued} tracks from **{name}**…", discord.Color.green()))
+                await music.start_loop(ctx, msg)
+            if end - start + 1 > len(data.get("entries") or []):
+                break  # short page: end of playlist
+            start = end + 1
+            page_size = PLAYLIST_PAGE_SIZE
+    except Exception as e:
+        if not queued:
+            return await msg.edit(embed=make_embed(f"❌ Error: {e}", discord.Color.red(), title="Error"))
+        await log_embed(f"⚠️ Playlist import stopped after {queued} tracks: {e}", discord.Color.red())
+    if not queued:
+        return await msg.edit(embed=make_embed("❌ Playlist is empty or unavailable.", discord.Color.red(), title="Error"))
+    progress(make_embed(f"✅ Queued {queued} tracks from **{name}**", discord.Color.green()))
+    await log_embed(f"✅ Playlist queued by {ctx.author.display_name}: {name} ({queued} tracks)")
+
 @bot.command(name="commands", help="List all commands.")
 @in_commands_channel()
 async def commands_list(ctx):
@@ -357,11 +2469,26 @@ async def help_command(ctx):
         value="Display the current music queue.",
         inline=False
     )
+    embed.add_field(
+        name="!remove [number] · !move [number] [to] · !shuffle",
+        value="Remove, reorder or shuffle queued tracks.",
+        inline=False
+    )
     embed.add_field(
         name="!tts [text]",
         value="Speak a message in your chosen TTS voice in the voice channel.",
         inline=False
     )
+    embed.add_field(
+        name="!search [words]",
+        value="Search tracks this bot has played before.",
+        inline=False
+    )
+    embed.add_field(
+        name="!stats",
+        value="Show playback timing statistics such as the gap between tracks.",
+        inline=False
+    )
     embed.add_field(
         name="!commands",
         value="List all available commands.",
@@ -374,96 +2501,181 @@ async def help_command(ctx):
 @in_commands_channel()
 async def tts(ctx, *, text: str):
     """Generate TTS and play in voice. Usable at any time."""
-    async with tts_lock:
+    music = players.get(ctx.guild.id)
+    async with music.tts_lock:
         if not ctx.author.voice or not ctx.author.voice.channel:
             await ctx.send(embed=make_embed("⚠️ You must be in a voice channel!", discord.Color.orange(), title="TTS Error"))
             await log_embed("⚠️ TTS playback error: Not connected to voice.", discord.Color.red())
             return
-        vc = ctx.guild.voice_client
-        if not vc or not vc.is_connected():
-            try:
-                vc = await ctx.author.voice.channel.connect()
-            except discord.errors.ClientException:
-                vc = ctx.guild.voice_client
-                if not vc:
-                    await ctx.send(embed=make_embed('⚠️ Failed to join voice channel.', discord.Color.red(), title="TTS Error"))
-                    await log_embed('⚠️ Failed to join voice channel.', discord.Color.red())
-                    return
+        vc = await voice_connections.connect(ctx.guild, ctx.author.voice.channel)
+        if not vc:
+            await ctx.send(embed=make_embed('⚠️ Failed to join voice channel.', discord.Color.red(), title="TTS Error"))
+            await log_embed('⚠️ Failed to join voice channel.', discord.Color.red())
+            return
 
-        # Prefetch TTS audio before pausing
-        tts_path = await generate_tts(text, user_id=ctx.author.id)
-        if not tts_path:
+        # Generate TTS audio before touching playback. Cached clips play
+        # from disk; otherwise streaming mode starts on the first chunk.
+        voice = await get_user_voice(ctx.author.id)
+        tts_path = tts_cache.get(tts_backend.cache_key(voice, text))
+        if tts_path:
+            metrics.inc("tts_cache_hits_total")
+            tts_source = clip_spec(tts_path)
+        elif TTS_STREAMING and not isinstance(vc.source, RemoteAudioSource):
+            # Audio workers open clips themselves, so streamed speech only mixes in-process
+            # With a local engine configured, a slow stream is abandoned at the TTS deadline
+            tts_source = await stream_tts(text, user_id=ctx.author.id,
+                                          timeout=TTS_DEADLINE if tts_local else TTS_STREAM_TIMEOUT)
+            if not tts_source and tts_local:
+                tts_path = await tts_request(tts_local, tts_local.voice, text)
+                tts_source = tts_path and clip_spec(tts_path)
+        else:
+            tts_path = await generate_tts(text, user_id=ctx.author.id)
+            tts_source = tts_path and clip_spec(tts_path)
+        if not tts_source:
             await ctx.send(embed=make_embed("⚠️ TTS generation failed.", discord.Color.red(), title="TTS Error"))
             await log_embed("⚠️ TTS generation failed.", discord.Color.red())
             return
 
-        # If music is playing, pause it, play TTS, then resume
-        was_playing = False
-        current_track = None
-        resume_seek = None
-        if vc.is_playing():
-            was_playing = True
-            # Get the current track and elapsed time for resuming
-            current_track = music.current if hasattr(music, 'current') else None
-            if current_track and hasattr(music, 'start_time') and music.start_time:
-                resume_seek = time.time() - music.start_time
-            else:
-                resume_seek = None
-            vc.pause()
-            await asyncio.sleep(0.2)  # Give a small buffer for pause
-
+        # Speak over whatever is playing; music is ducked, not stopped
         done = asyncio.Event()
-        def tts_done(_): bot.loop.call_soon_threadsafe(done.set)
+        loop = asyncio.get_running_loop()
+        def tts_done(_): loop.call_soon_threadsafe(done.set)
         try:
-            vc.play(
-                discord.PCMVolumeTransformer(
-                    discord.FFmpegPCMAudio(tts_path, options='-loglevel panic'),
-                    volume=1.0
-                ),
-                after=tts_done
-            )
+            mixer, needs_play = attach_mixer(vc)
+            mixer.overlay(tts_source, after=tts_done)
+            if needs_play:
+                vc.play(mixer)
             await done.wait()
-            if was_playing and current_track and resume_seek is not None:
-                try:
-                    # Stop any paused playback
-                    if vc.is_playing() or vc.is_paused():
-                        vc.stop()
-                    # Re-create the audio stream with seek
-                    audio_stream = discord.PCMVolumeTransformer(
-                        discord.FFmpegPCMAudio(
-                            current_track.url,
-                            before_options=f'-ss {int(resume_seek)} -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -vn',
-                            options='-loglevel panic'
-                        ),
-                        volume=0.3
-                    )
-                    done_resume = asyncio.Event()
-                    def song_resume_done(_): bot.loop.call_soon_threadsafe(done_resume.set)
-                    vc.play(audio_stream, after=song_resume_done)
-                    # Update music.start_time
-                    music.start_time = time.time() - (resume_seek if resume_seek else 0)
-                except Exception as e:
-                    await ctx.send(embed=make_embed(f"⚠️ Failed to resume music after TTS: {e}", discord.Color.red(), title="Resume Error"))
-                    await log_embed(f"⚠️ Failed to resume music after TTS: {e}", discord.Color.red())
             if ctx.channel.id == commands_channel_id:
-                await ctx.send(embed=make_embed(f"🗣️ Spoke your message in **{await get_user_voice(ctx.author.id)}** voice.", discord.Color.green(), title="TTS Complete"))
+                await ctx.send(embed=make_embed(f"🗣️ Spoke your message in **{voice}** voice.", discord.Color.green(), title="TTS Complete"))
         except Exception as e:
             if ctx.channel.id == commands_channel_id:
                 await ctx.send(embed=make_embed(f"⚠️ TTS playback error: {e}", discord.Color.red(), title="TTS Error"))
             await log_embed(f"⚠️ TTS playback error: {e}", discord.Color.red())
+        if not (music.loop_task and not music.loop_task.done()):
+            voice_connections.release(ctx.guild)
+
+class QueuePager(discord.ui.View):
+    """Previous/next buttons over a guild's queue.
+
+    Pages are found by position key (keyset paging), so turning a page
+    costs a bisect rather than a scan, and pages stay stable while tracks
+    before them are played or removed.
+    """
+    def __init__(self, guild_id, page_size=QUEUE_PAGE_SIZE):
+        super().__init__(timeout=180)
+        self.guild_id = guild_id
+        self.page_size = page_size
+        self.keys = [float("-inf")]  # position each visited page starts after
+        self.last = None  # position of the last entry shown
+
+    async def render(self):
+        start, tracks = await storage.page(self.guild_id, self.keys[-1], self.page_size)
+        total = len(await storage.guild_queue(self.guild_id))
+        if not tracks and len(self.keys) > 1:
+            # Everything on this page was played or removed; fall back a page
+            self.keys.pop()
+            return await self.render()
+        self.last = tracks[-1].position if tracks else None
+        self.previous_page.disabled = len(self.keys) == 1
+        self.next_page.disabled = start + len(tracks) >= total
+        if not tracks:
+            return make_embed("📭 The queue is empty.", discord.Color.orange(), title="Queue Empty")
+        lines = "\n".join(f"{start + i + 1}. {t.title}" for i, t in enumerate(tracks))
+        return make_embed(f"🎵 Queue:\n{lines}", footer=f"{start + 1}–{start + len(tracks)} of {total}")
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        if len(self.keys) > 1:
+            self.keys.pop()
+        await interaction.response.edit_message(embed=await self.render(), view=self)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        if self.last is not None:
+            self.keys.append(self.last)
+        await interaction.response.edit_message(embed=await self.render(), view=self)
 
 @bot.command(name="showqueue", help="Display the current music queue.")
 @in_commands_channel()
 async def showqueue(ctx):
-    queue = await music.show_queue(ctx.guild.id)
-    if not queue:
+    if not await storage.guild_queue(ctx.guild.id):
         if ctx.channel.id == commands_channel_id:
             await ctx.send(embed=make_embed("📭 The queue is empty.", discord.Color.orange(), title="Queue Empty"))
-        await ctx.send("📭 The queue is empty.")
-    else:
-        msg = "\n".join(f"{i+1}. {title}" for i, title in enumerate(queue))
-        if ctx.channel.id == commands_channel_id:
-            await ctx.send(embed=make_embed(f"🎵 Queue:\n{msg}"))
+        return
+    pager = QueuePager(ctx.guild.id)
+    embed = await pager.render()
+    if ctx.channel.id == commands_channel_id:
+        await ctx.send(embed=embed, view=pager if not pager.next_page.disabled else None)
+
+async def queue_index(ctx, number):
+    """0-based index for a 1-based queue number, or None after telling the user it is out of range."""
+    size = len(await storage.guild_queue(ctx.guild.id))
+    if 1 <= number <= size:
+        return number - 1
+    await ctx.send(embed=make_embed(f"❌ Pick a number between 1 and {size}." if size else "📭 The queue is empty.",
+                                    discord.Color.orange(), title="Queue"))
+    return None
+
+@bot.command(name="remove", help="Remove a track from the queue by its number.")
+@in_commands_channel()
+async def remove(ctx, number: int):
+    index = await queue_index(ctx, number)
+    if index is None:
+        return
+    track = await players.get(ctx.guild.id).remove_from_queue(ctx.guild.id, index)
+    await ctx.send(embed=make_embed(f"🗑️ Removed **{track.title}** from the queue.", discord.Color.green(), title="Queue"))
+    await log_embed(f"🗑️ {ctx.author.display_name} removed: {track.title}")
+
+@bot.command(name="move", help="Move a queued track to another position.")
+@in_commands_channel()
+async def move(ctx, number: int, to: int):
+    src = await queue_index(ctx, number)
+    dst = await queue_index(ctx, to) if src is not None else None
+    if dst is None:
+        return
+    track = await players.get(ctx.guild.id).move_in_queue(ctx.guild.id, src, dst)
+    await ctx.send(embed=make_embed(f"↕️ Moved **{track.title}** to position {to}.", discord.Color.green(), title="Queue"))
+
+@bot.command(name="shuffle", help="Shuffle the queue.")
+@in_commands_channel()
+async def shuffle(ctx):
+    if not await storage.guild_queue(ctx.guild.id):
+        return await ctx.send(embed=make_embed("📭 The queue is empty.", discord.Color.orange(), title="Queue Empty"))
+    await players.get(ctx.guild.id).shuffle_queue(ctx.guild.id)
+    await ctx.send(embed=make_embed("🔀 Queue shuffled.", discord.Color.green(), title="Queue"))
+    await log_embed(f"🔀 Queue shuffled by {ctx.author.display_name}")
+
+@bot.command(name="search", help="Search previously played tracks.")
+@in_commands_channel()
+async def search(ctx, *, query: str):
+    rows = await storage.search_tracks(query, limit=10)
+    if not rows:
+        return await ctx.send(embed=make_embed(f"🔍 No previously played tracks match `{query}`.", discord.Color.orange(), title="Search"))
+    lines = "\n".join(f"{i+1}. {row[0]} · {row[9]} play{'s' if row[9] != 1 else ''}" for i, row in enumerate(rows))
+    await ctx.send(embed=make_embed(f"{lines}\n\nUse `!play <title>` to queue one.", discord.Color.blurple(), title=f"Search: {query}"))
+
+@bot.command(name="stats", help="Show playback timing statistics.")
+@in_commands_channel()
+async def stats(ctx):
+    gap = metrics.summary("track_gap_seconds")
+    top = await storage.popular_tracks(time.time() - 7 * 86400, 5, guild_id=ctx.guild.id)
+    if not gap and not top:
+        return await ctx.send(embed=make_embed("📊 No track transitions recorded yet.", discord.Color.orange(), title="Stats"))
+    parts = []
+    if gap:
+        parts.append(
+            f"**Gap between tracks** ({gap['count']} transitions)\n"
+            f"avg {gap['avg']*1000:.0f} ms · p50 {gap['p50']*1000:.0f} ms · "
+            f"p95 {gap['p95']*1000:.0f} ms · max {gap['max']*1000:.0f} ms")
+    if top:
+        titles = {}
+        for video_id, _ in top:
+            track = await extraction_cache.lookup_video(video_id)
+            titles[video_id] = track.title if track else video_id
+        parts.append("**Most requested here this week**\n" + "\n".join(
+            f"{i+1}. {titles[video_id]} · {plays}" for i, (video_id, plays) in enumerate(top)))
+    await ctx.send(embed=make_embed("\n\n".join(parts), discord.Color.blurple(), title="Stats"))
 
 @bot.command(name="skip", help="Skip the current song.")
 @in_commands_channel()
@@ -474,27 +2686,43 @@ async def skip(ctx):
         if ctx.channel.id == commands_channel_id:
             await ctx.send("⏭ Skipped.")
         if ctx.channel.id == commands_channel_id:
-            await music.start_loop(ctx, await ctx.send("⏳ Loading next track..."))
+            await players.get(ctx.guild.id).start_loop(ctx, await ctx.send("⏳ Loading next track..."))
     else:
         if ctx.channel.id == commands_channel_id:
             await ctx.send("❌ Nothing is playing.")
 
 @bot.command(name="stop")
 async def stop(ctx):
-    vc = ctx.guild.voice_client
-    if vc and vc.is_connected():
-        await vc.disconnect(force=True)
+    await voice_connections.disconnect(ctx.guild, force=True)
+    music = players.get(ctx.guild.id)
     music.current = None
     music.playing = False
-    music.start_time = None
     if music.loop_task and not music.loop_task.done():
         music.loop_task.cancel()
+    for task in music.prepared.values():
+        task.cancel()
+    music.prepared.clear()
+    music.resume = None
+    storage.clear_queue(ctx.guild.id)
+    storage.clear_player_state(ctx.guild.id)
     if ctx.channel.id == commands_channel_id:
         await ctx.send("🛑 Stopped and disconnected.")
 
 @bot.event
 async def on_ready():
     print(f"✅ Logged in as {bot.user}")
+    players.start_sweeper()
+    prefetcher.start()
+    voice_connections.start()
+    outbox.start()
+    watchdog.start()
+    if METRICS_PORT and not getattr(bot, "metrics_started", False):
+        bot.metrics_started = True
+        await start_metrics_server()
+    # on_ready fires again after reconnects; only restore sessions once
+    if not getattr(bot, "sessions_restored", False):
+        bot.sessions_restored = True
+        await players.restore()
     # Do not send any message in any channel
 
 @bot.event
@@ -525,4 +2753,7 @@ async def on_command_error(ctx, error):
         await ctx.send(embed=embed)
         await log_embed(f"⚠️ Command error: {error}", discord.Color.red())
 
-bot.run(TOKEN)
+if __name__ == "__main__":
+    bot.run(TOKEN)
+    # Commit any writes still waiting in the writer thread
+    storage.close()